@@ -2,14 +2,21 @@ from __future__ import annotations
 
 import csv
 import io
+import itertools
 import sqlite3
 import os
+import queue
 import re
+import sys
+import tempfile
+import zlib
 import openpyxl
+import orjson
 from openpyxl.utils import get_column_letter
 
+from collections import Counter
 from dataclasses import dataclass
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from functools import wraps
 from pathlib import Path
@@ -20,8 +27,9 @@ from flask import (
     session, Response, jsonify,
     abort,
     send_file,
-    make_response
+    stream_with_context,
 )
+from flask_caching import Cache
 from werkzeug.security import generate_password_hash, check_password_hash
 
 APP_DIR = Path(__file__).resolve().parent
@@ -36,15 +44,30 @@ RETURNS_NAME = "Returns (Virtual)"
 
 STORE_TZ = ZoneInfo("America/Phoenix")
 
+
+def _fixed_utc_offset_minutes(tz) -> Optional[int]:
+    # None when the zone observes DST (offset differs between Jan and Jul)
+    year = datetime.now(timezone.utc).year
+    jan = datetime(year, 1, 1, tzinfo=tz).utcoffset()
+    jul = datetime(year, 7, 1, tzinfo=tz).utcoffset()
+    if jan != jul:
+        return None
+    return int(jan.total_seconds() // 60)
+
+
+STORE_TZ_OFFSET_MINUTES = _fixed_utc_offset_minutes(STORE_TZ)
+
 ROLE_ADMIN = "admin"
 ROLE_STAFF = "staff"
 DEFAULT_LOCATION_NAME = "Main Store"
 
-ACTION_RECEIVE = "RECEIVE"
-ACTION_MOVE = "MOVE"
-ACTION_SOLD = "SOLD"
-ACTION_MISSING = "MISSING"
-ACTION_RETURN = "RETURN"
+# Interned so the daily activity loops, which intern each row's action, can
+# compare by identity instead of character by character.
+ACTION_RECEIVE = sys.intern("RECEIVE")
+ACTION_MOVE = sys.intern("MOVE")
+ACTION_SOLD = sys.intern("SOLD")
+ACTION_MISSING = sys.intern("MISSING")
+ACTION_RETURN = sys.intern("RETURN")
 ACTION_CASE_CREATE = "CASE_CREATE"
 ACTION_CASE_DELETE = "CASE_DELETE"
 ACTION_CASE_EDIT = "CASE_EDIT"
@@ -109,10 +132,16 @@ RETURN_DIAMOND_OPTIONS = {"Y", "N", "N/A"}
 LOCATION_CASE = "CASE"
 LOCATION_RESERVE = "RESERVE"
 INVENTORY_LOCATIONS = {LOCATION_CASE, LOCATION_RESERVE}
+INVENTORY_CHANGED_MSG = "Inventory changed while saving; nothing was updated. Please re-scan and try again."
 
 app = Flask(__name__)
 app.secret_key = "change-this-in-production"
 
+# In-process cache for per-location case lists/grid data. Entries are dropped
+# on every case or inventory write; timeouts bound staleness if several
+# worker processes each hold their own copy.
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
+
 
 def _virtual_case_code(base_code: str, location_id: Optional[int], default_location_id: Optional[int]) -> str:
     if not location_id or location_id == default_location_id:
@@ -122,15 +151,160 @@ def _virtual_case_code(base_code: str, location_id: Optional[int], default_locat
 
 
 # ---------------- DB helpers ----------------
+# WAL lets report/export reads run alongside writes; the rest keep hot pages
+# in memory (64 MB page cache, 256 MB mmap) for the history scans.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA foreign_keys = ON;",
+    "PRAGMA busy_timeout = 5000;",
+)
+# journal_mode is a property of the file; read-only connections just inherit it.
+READ_CONNECTION_PRAGMAS = CONNECTION_PRAGMAS[2:]
+READ_POOL_SIZE = 4
+
+
+def _tune_connection(conn: sqlite3.Connection, pragmas: Tuple[str, ...] = CONNECTION_PRAGMAS) -> None:
+    for pragma in pragmas:
+        conn.execute(pragma)
+
+
+# Read-only connections reused across requests so GET pages keep a warm page
+# cache instead of starting from a cold connection every time.
+_read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=READ_POOL_SIZE)
+
+
+def _close_read_pool() -> None:
+    while True:
+        try:
+            _read_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+# Per-case inventory totals, kept in step with inventory by triggers so the
+# case grid and case page read one row instead of aggregating inventory.
+# distinct_upcs counts a UPC once even when it sits in both CASE and RESERVE.
+CASE_TOTALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS case_totals (
+    location_id INTEGER NOT NULL,
+    case_code TEXT NOT NULL,
+    case_qty INTEGER NOT NULL DEFAULT 0,
+    case_upcs INTEGER NOT NULL DEFAULT 0,
+    reserve_qty INTEGER NOT NULL DEFAULT 0,
+    reserve_upcs INTEGER NOT NULL DEFAULT 0,
+    total_qty INTEGER NOT NULL DEFAULT 0,
+    distinct_upcs INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(location_id, case_code)
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_totals_insert AFTER INSERT ON inventory
+BEGIN
+    INSERT OR IGNORE INTO case_totals (location_id, case_code) VALUES (NEW.location_id, NEW.case_code);
+    UPDATE case_totals SET
+        case_qty = case_qty + (CASE WHEN NEW.location = 'CASE' THEN NEW.qty ELSE 0 END),
+        case_upcs = case_upcs + (NEW.location = 'CASE'),
+        reserve_qty = reserve_qty + (CASE WHEN NEW.location = 'RESERVE' THEN NEW.qty ELSE 0 END),
+        reserve_upcs = reserve_upcs + (NEW.location = 'RESERVE'),
+        total_qty = total_qty + NEW.qty,
+        distinct_upcs = distinct_upcs + NOT EXISTS (
+            SELECT 1 FROM inventory i
+            WHERE i.case_code = NEW.case_code AND i.location_id = NEW.location_id
+              AND i.upc = NEW.upc AND i.location <> NEW.location
+        )
+    WHERE location_id = NEW.location_id AND case_code = NEW.case_code;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_totals_update AFTER UPDATE OF qty ON inventory
+BEGIN
+    UPDATE case_totals SET
+        case_qty = case_qty + (CASE WHEN NEW.location = 'CASE' THEN NEW.qty - OLD.qty ELSE 0 END),
+        reserve_qty = reserve_qty + (CASE WHEN NEW.location = 'RESERVE' THEN NEW.qty - OLD.qty ELSE 0 END),
+        total_qty = total_qty + NEW.qty - OLD.qty
+    WHERE location_id = NEW.location_id AND case_code = NEW.case_code;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_inventory_totals_delete AFTER DELETE ON inventory
+BEGIN
+    UPDATE case_totals SET
+        case_qty = case_qty - (CASE WHEN OLD.location = 'CASE' THEN OLD.qty ELSE 0 END),
+        case_upcs = case_upcs - (OLD.location = 'CASE'),
+        reserve_qty = reserve_qty - (CASE WHEN OLD.location = 'RESERVE' THEN OLD.qty ELSE 0 END),
+        reserve_upcs = reserve_upcs - (OLD.location = 'RESERVE'),
+        total_qty = total_qty - OLD.qty,
+        distinct_upcs = distinct_upcs - NOT EXISTS (
+            SELECT 1 FROM inventory i
+            WHERE i.case_code = OLD.case_code AND i.location_id = OLD.location_id
+              AND i.upc = OLD.upc AND i.location <> OLD.location
+        )
+    WHERE location_id = OLD.location_id AND case_code = OLD.case_code;
+END;
+"""
+
+
+def _ensure_case_totals(conn: sqlite3.Connection, rebuild: bool = False) -> None:
+    """Create case_totals + triggers if missing; (re)fill from inventory when new or rebuild=True."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='case_totals'"
+    ).fetchone()
+    if exists and not rebuild:
+        return
+    conn.executescript(CASE_TOTALS_SCHEMA)
+    conn.execute("DELETE FROM case_totals")
+    conn.execute(
+        """
+        INSERT INTO case_totals (
+            location_id, case_code, case_qty, case_upcs, reserve_qty, reserve_upcs, total_qty, distinct_upcs
+        )
+        SELECT location_id,
+               case_code,
+               COALESCE(SUM(CASE WHEN location = 'CASE' THEN qty ELSE 0 END), 0),
+               SUM(location = 'CASE'),
+               COALESCE(SUM(CASE WHEN location = 'RESERVE' THEN qty ELSE 0 END), 0),
+               SUM(location = 'RESERVE'),
+               COALESCE(SUM(qty), 0),
+               COUNT(DISTINCT upc)
+        FROM inventory
+        GROUP BY location_id, case_code
+        """
+    )
+    conn.commit()
+
+
+# Virtual cases are created with their location (locations_admin) and checked
+# once per process here, not on every request or form post.
+_virtual_cases_ready = False
+
+
+def _ensure_virtual_cases(conn: sqlite3.Connection, default_location_id: Optional[int]) -> None:
+    """INSERT OR IGNORE the New Receipts and Returns cases for every location."""
+    now = utc_now()
+    rows = []
+    for loc in conn.execute("SELECT id FROM locations").fetchall():
+        rows.append((_virtual_case_code(NEW_RECEIPTS_CODE, loc[0], default_location_id), loc[0], NEW_RECEIPTS_NAME, now))
+        rows.append((_virtual_case_code(RETURNS_CODE, loc[0], default_location_id), loc[0], RETURNS_NAME, now))
+    conn.executemany(
+        """
+        INSERT OR IGNORE INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at)
+        VALUES (?, ?, ?, 1, 1, ?)
+        """,
+        rows,
+    )
+
+
 def get_db() -> sqlite3.Connection:
+    global _virtual_cases_ready
     # Ensure DB + tables exist even under WSGI / Windows services
     if not DB_PATH.exists():
         init_db()
 
     if "db" not in g:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
         conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA foreign_keys = ON;")
+        _tune_connection(conn)
 
         # If the DB file exists but tables don't (or were wiped), rebuild schema.
         try:
@@ -138,11 +312,12 @@ def get_db() -> sqlite3.Connection:
         except sqlite3.OperationalError:
             conn.close()
             init_db()
-            conn = sqlite3.connect(DB_PATH)
+            conn = sqlite3.connect(DB_PATH, cached_statements=256)
             conn.row_factory = sqlite3.Row
-            conn.execute("PRAGMA foreign_keys = ON;")
+            _tune_connection(conn)
 
         # Lightweight migrations (safe no-ops if already applied)
+        virtual_cases_ensured = False
         try:
             conn.execute(
                 """
@@ -167,16 +342,9 @@ def get_db() -> sqlite3.Connection:
                 ).fetchone()
             default_location_id = default_location["id"]
 
-            locations = conn.execute("SELECT id FROM locations").fetchall()
-            for loc in locations:
-                returns_code = _virtual_case_code(RETURNS_CODE, loc["id"], default_location_id)
-                conn.execute(
-                    """
-                    INSERT OR IGNORE INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at)
-                    VALUES (?, ?, ?, 1, 1, ?)
-                    """,
-                    (returns_code, loc["id"], RETURNS_NAME, utc_now()),
-                )
+            if not _virtual_cases_ready:
+                _ensure_virtual_cases(conn, default_location_id)
+                virtual_cases_ensured = True
 
             user_cols = [r["name"] for r in conn.execute("PRAGMA table_info(users)").fetchall()]
             if "location_id" not in user_cols:
@@ -198,6 +366,13 @@ def get_db() -> sqlite3.Connection:
             if "location_id" not in hist_cols:
                 conn.execute("ALTER TABLE history ADD COLUMN location_id INTEGER")
                 conn.execute("UPDATE history SET location_id=? WHERE location_id IS NULL", (default_location_id,))
+            if "item_type" not in hist_cols:
+                # item_type is copied onto history at insert so history lists skip the products join.
+                conn.execute("ALTER TABLE history ADD COLUMN item_type TEXT")
+                conn.execute(
+                    "UPDATE history SET item_type=(SELECT p.item_type FROM products p WHERE p.upc = history.upc) "
+                    "WHERE upc IS NOT NULL"
+                )
 
             cols = [r["name"] for r in conn.execute("PRAGMA table_info(case_counts)").fetchall()]
             if "other" not in cols:
@@ -381,21 +556,65 @@ def get_db() -> sqlite3.Connection:
                     )
                 conn.execute("DROP TABLE inventory_old;")
                 conn.execute("PRAGMA foreign_keys = ON;")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_inv_case ON inventory(case_code, location_id);")
                 conn.execute("CREATE INDEX IF NOT EXISTS idx_inv_upc ON inventory(upc);")
-                conn.execute("CREATE INDEX IF NOT EXISTS idx_inv_case_location ON inventory(case_code, location_id, location);")
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_inv_loc_case ON inventory(location_id, case_code, location, upc, qty);"
+                )
+                # The rebuilt table has no totals triggers yet
+                _ensure_case_totals(conn, rebuild=True)
         except sqlite3.OperationalError:
             pass
 
+        try:
+            _ensure_case_totals(conn)
+        except sqlite3.OperationalError:
+            pass
+
+        # The migration UPDATEs above open an implicit transaction; commit it here,
+        # or a request that never commits (any GET) rolls the backfills back while
+        # the added columns make sure they never run again.
+        if conn.in_transaction:
+            conn.commit()
+        # Only mark the virtual cases done once their INSERT OR IGNORE is committed.
+        if virtual_cases_ensured:
+            _virtual_cases_ready = True
+
         g.db = conn
     return g.db
 
 
+def get_read_db() -> sqlite3.Connection:
+    """
+    Read-only connection for GET views, borrowed from a small process-wide pool.
+    Only use it after get_db() has run for the request (login_required does
+    this via current_user), so the schema and migrations are in place.
+    """
+    if "read_db" not in g:
+        try:
+            conn = _read_pool.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(
+                f"{DB_PATH.as_uri()}?mode=ro", uri=True, check_same_thread=False, cached_statements=256
+            )
+            conn.row_factory = sqlite3.Row
+            _tune_connection(conn, READ_CONNECTION_PRAGMAS)
+        g.read_db = conn
+    return g.read_db
+
+
 @app.teardown_appcontext
 def close_db(exception=None):
     db = g.pop("db", None)
     if db is not None:
         db.close()
+    read_db = g.pop("read_db", None)
+    if read_db is not None:
+        if read_db.in_transaction:
+            read_db.rollback()
+        try:
+            _read_pool.put_nowait(read_db)
+        except queue.Full:
+            read_db.close()
 
 
 def utc_now() -> str:
@@ -416,6 +635,24 @@ def store_now() -> datetime:
     return datetime.now(STORE_TZ)
 
 
+def export_stamp() -> str:
+    """Store-local MM-DD-YYYY_HHMM for export filenames."""
+    dt = now_local_dt()
+    return f"{dt.month:02d}-{dt.day:02d}-{dt.year:04d}_{dt.hour:02d}{dt.minute:02d}"
+
+
+_MDY_RE = re.compile(r"^(\d{2})/(\d{2})/(\d{4})$")
+
+
+def report_date_arg() -> str:
+    """?date= as YYYY-MM-DD (MM/DD/YYYY accepted too); defaults to the store-local today."""
+    date_q = request.args.get("date") or local_date_str()
+    m = _MDY_RE.match(date_q)
+    if m:
+        date_q = f"{m.group(3)}-{m.group(1)}-{m.group(2)}"
+    return date_q
+
+
 
 
 def _parse_iso_utc(value: str) -> Optional[datetime]:
@@ -467,6 +704,8 @@ app.jinja_env.filters["local_ts"] = fmt_local_ts
 app.jinja_env.filters["mmddyyyy"] = fmt_mmddyyyy
 
 def init_db():
+    # Pooled read connections may point at a file that is about to be replaced.
+    _close_read_pool()
     db = sqlite3.connect(DB_PATH)
     db.row_factory = sqlite3.Row
     db.execute("PRAGMA foreign_keys = ON;")
@@ -564,16 +803,13 @@ CREATE INDEX IF NOT EXISTS idx_case_counts_case ON case_counts(case_code, locati
     ticket_price REAL,
     diamond_test TEXT,
     location_id INTEGER,
+    item_type TEXT,
     FOREIGN KEY(user_id) REFERENCES users(id),
     FOREIGN KEY(location_id) REFERENCES locations(id)
 );
 
-        CREATE INDEX IF NOT EXISTS idx_inv_case ON inventory(case_code, location_id);
         CREATE INDEX IF NOT EXISTS idx_inv_upc ON inventory(upc);
-        CREATE INDEX IF NOT EXISTS idx_inv_case_location ON inventory(case_code, location_id, location);
         CREATE INDEX IF NOT EXISTS idx_hist_upc ON history(upc);
-        CREATE INDEX IF NOT EXISTS idx_hist_case_from ON history(from_case_code);
-        CREATE INDEX IF NOT EXISTS idx_hist_case_to ON history(to_case_code);
         """
     )
 
@@ -603,24 +839,8 @@ CREATE INDEX IF NOT EXISTS idx_case_counts_case ON case_counts(case_code, locati
             "SELECT id FROM locations ORDER BY id LIMIT 1"
         ).fetchone()
     default_location_id = default_location["id"]
-    # Ensure New Receipts exists
-    db.execute(
-        """
-        INSERT OR IGNORE INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at)
-        VALUES (?, ?, ?, 1, 1, ?)
-        """,
-        (NEW_RECEIPTS_CODE, default_location_id, NEW_RECEIPTS_NAME, utc_now()),
-    )
-    locations = db.execute("SELECT id FROM locations").fetchall()
-    for loc in locations:
-        returns_code = _virtual_case_code(RETURNS_CODE, loc["id"], default_location_id)
-        db.execute(
-            """
-            INSERT OR IGNORE INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at)
-            VALUES (?, ?, ?, 1, 1, ?)
-            """,
-            (returns_code, loc["id"], RETURNS_NAME, utc_now()),
-        )
+    # Ensure New Receipts / Returns exist for every location
+    _ensure_virtual_cases(db, default_location_id)
 
     # --- Lightweight migration for history SOLD fields (safe on existing DBs)
     try:
@@ -638,6 +858,41 @@ CREATE INDEX IF NOT EXISTS idx_case_counts_case ON case_counts(case_code, locati
     except Exception:
         pass
 
+    # --- Location-scoped composite indexes (safe on existing DBs)
+    # Every inventory/history query filters on location_id first. The history
+    # pairs serve each side of the from/to UNION ALL, ordered by id (case page)
+    # or bounded by ts (daily activity). idx_hist_loc / idx_case_counts_loc
+    # (rowid is the implicit last column) let the unfiltered history and count
+    # lists walk one location in id order and stop at the LIMIT.
+    try:
+        db.executescript(
+            """
+            CREATE INDEX IF NOT EXISTS idx_inv_loc_case ON inventory(location_id, case_code, location, upc, qty);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc ON history(location_id);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc_upc ON history(location_id, upc, id DESC);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc_from ON history(location_id, from_case_code, id DESC);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc_to ON history(location_id, to_case_code, id DESC);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc_from_ts ON history(location_id, from_case_code, ts);
+            CREATE INDEX IF NOT EXISTS idx_hist_loc_to_ts ON history(location_id, to_case_code, ts);
+            CREATE INDEX IF NOT EXISTS idx_case_counts_loc ON case_counts(location_id);
+
+            -- idx_inv_case is a prefix of the inventory primary key; the rest are
+            -- superseded by the location-leading indexes above.
+            DROP INDEX IF EXISTS idx_inv_case;
+            DROP INDEX IF EXISTS idx_inv_case_location;
+            DROP INDEX IF EXISTS idx_hist_case_from;
+            DROP INDEX IF EXISTS idx_hist_case_to;
+            """
+        )
+    except sqlite3.OperationalError:
+        pass
+
+    # --- Materialized per-case totals, resynced from inventory on every boot
+    try:
+        _ensure_case_totals(db, rebuild=True)
+    except sqlite3.OperationalError:
+        pass
+
     db.commit()
     db.close()
 
@@ -664,6 +919,11 @@ def current_user() -> Optional[CurrentUser]:
     uid = session.get("user_id")
     if not uid:
         return None
+    # Called from most helpers; look the user up once per request (keyed by
+    # uid so a login/logout mid-request is still seen).
+    cached = g.get("_current_user")
+    if cached is not None and cached[0] == uid:
+        return cached[1]
     db = get_db()
     row = db.execute(
         "SELECT id, username, role, location_id FROM users WHERE id=? AND is_active=1",
@@ -672,12 +932,14 @@ def current_user() -> Optional[CurrentUser]:
     if not row:
         session.pop("user_id", None)
         return None
-    return CurrentUser(
+    user = CurrentUser(
         id=row["id"],
         username=row["username"],
         role=row["role"],
         location_id=row["location_id"],
     )
+    g._current_user = (uid, user)
+    return user
 
 
 def login_required(fn):
@@ -712,7 +974,10 @@ def login_required(fn):
                 session.pop("user_id", None)
                 flash("No store location assigned. Contact an admin.", "danger")
                 return redirect(url_for("login"))
-            session["location_id"] = u.location_id
+            # Assign only on change: any write marks the session modified and
+            # re-signs/re-sends the cookie on every response (exports included).
+            if session.get("location_id") != u.location_id:
+                session["location_id"] = u.location_id
         return fn(*args, **kwargs)
     return wrapper
 
@@ -752,22 +1017,25 @@ def current_location() -> Optional[sqlite3.Row]:
     ).fetchone()
 
 
+def _default_location_id() -> Optional[int]:
+    # First location keeps the bare virtual case codes; looked up once per request.
+    if "_default_location_id" not in g:
+        db = get_db()
+        row = db.execute("SELECT id FROM locations ORDER BY id LIMIT 1").fetchone()
+        g._default_location_id = row["id"] if row else None
+    return g._default_location_id
+
+
 def new_receipts_case_code(location_id: Optional[int]) -> str:
     if not location_id:
         return NEW_RECEIPTS_CODE
-    db = get_db()
-    row = db.execute("SELECT id FROM locations ORDER BY id LIMIT 1").fetchone()
-    default_location_id = row["id"] if row else None
-    return _virtual_case_code(NEW_RECEIPTS_CODE, location_id, default_location_id)
+    return _virtual_case_code(NEW_RECEIPTS_CODE, location_id, _default_location_id())
 
 
 def returns_case_code(location_id: Optional[int]) -> str:
     if not location_id:
         return RETURNS_CODE
-    db = get_db()
-    row = db.execute("SELECT id FROM locations ORDER BY id LIMIT 1").fetchone()
-    default_location_id = row["id"] if row else None
-    return _virtual_case_code(RETURNS_CODE, location_id, default_location_id)
+    return _virtual_case_code(RETURNS_CODE, location_id, _default_location_id())
 
 
 @app.context_processor
@@ -786,33 +1054,32 @@ def _initials_from_username(username: str) -> str:
     u = re.sub(r"[^A-Za-z0-9]", "", username)
     return (u[:2] if len(u) >= 2 else u).upper()
 
+_ITEM_CODE_MAP = {
+    "ring": "R",
+    "earring": "E",
+    "earrings": "E",
+    "necklace": "N",
+    "bracelet": "B",
+    "other": "O",
+}
+
+# Matches the legend in the template
+_REASON_CODE_MAP = {
+    ACTION_RECEIVE: "NRT",
+    ACTION_MOVE: "M",
+    ACTION_SOLD: "S",
+    ACTION_MISSING: "D",  # closest match in template legend
+    ACTION_RETURN: "R",
+}
+
 def _item_code(item_type: str) -> str:
-    m = {
-        "ring": "R",
-        "earring": "E",
-        "earrings": "E",
-        "necklace": "N",
-        "bracelet": "B",
-        "other": "O",
-    }
     if not item_type:
         return "O"
-    return m.get(item_type.strip().lower(), "O")
+    return _ITEM_CODE_MAP.get(item_type.strip().lower(), "O")
 
 def _reason_code(action: str) -> str:
     a = (action or "").upper()
-    # Matches the legend in the template
-    if a == "RECEIVE":
-        return "NRT"
-    if a == "MOVE":
-        return "M"
-    if a == "SOLD":
-        return "S"
-    if a == "MISSING":
-        return "D"  # closest match in template legend
-    if a == "RETURN":
-        return "R"
-    return a[:3]
+    return _REASON_CODE_MAP.get(a) or a[:3]
 
 def _parse_iso_to_store(value: str):
     if not value:
@@ -830,24 +1097,58 @@ def _parse_iso_to_store(value: str):
     return dt.astimezone(STORE_TZ)
 
 def _local_date_str_from_ts(ts: str) -> str:
+    s = ts or ""
+    # Fast path for utc_now() stamps (YYYY-MM-DDTHH:MM:SS+00:00): shift the
+    # time of day by the store offset and only parse fully near midnight.
+    if (
+        STORE_TZ_OFFSET_MINUTES is not None
+        and len(s) == 25
+        and s[10] == "T"
+        and s.endswith("+00:00")
+        and s[11:13].isdigit()
+        and s[14:16].isdigit()
+    ):
+        minutes = int(s[11:13]) * 60 + int(s[14:16]) + STORE_TZ_OFFSET_MINUTES
+        if 0 <= minutes < 1440:
+            return s[:10]
     dt = _parse_iso_to_store(ts)
     if not dt:
         return ""
     return dt.date().isoformat()
 
+def _history_ts_window(local_date: str) -> tuple[str, str]:
+    """Loose [lo, hi) bound on history.ts for events on a store-local date.
+
+    Padded by two days either side so any timestamp format/offset still lands
+    inside; callers keep the exact _local_date_str_from_ts filter.
+    """
+    try:
+        d = datetime.fromisoformat(local_date).date()
+    except ValueError:
+        return local_date, local_date
+    return (d - timedelta(days=2)).isoformat(), (d + timedelta(days=3)).isoformat()
+
 def _daily_activity_totals(case_code: str, local_date: str, location_id: int) -> tuple[int, int, int]:
     db = get_db()
+    ts_lo, ts_hi = _history_ts_window(local_date)
+    # OR on from/to defeats the per-side indexes; UNION ALL lets each branch seek.
     events = db.execute(
         """
-        SELECT h.ts, h.action, h.qty, h.from_case_code, h.to_case_code
+        SELECT h.id AS id, h.ts AS ts, h.action, h.qty, h.from_case_code, h.to_case_code
         FROM history h
         WHERE h.action IN ('RECEIVE','MOVE','SOLD','MISSING','RETURN')
-          AND h.location_id = ?
-          AND (h.from_case_code = ? OR h.to_case_code = ?)
-        ORDER BY h.ts ASC, h.id ASC
+          AND h.location_id = ? AND h.from_case_code = ?
+          AND h.ts >= ? AND h.ts < ?
+        UNION ALL
+        SELECT h.id, h.ts, h.action, h.qty, h.from_case_code, h.to_case_code
+        FROM history h
+        WHERE h.action IN ('RECEIVE','MOVE','SOLD','MISSING','RETURN')
+          AND h.location_id = ? AND h.to_case_code = ? AND h.from_case_code IS NOT ?
+          AND h.ts >= ? AND h.ts < ?
+        ORDER BY ts ASC, id ASC
         """,
-        (location_id, case_code, case_code),
-    ).fetchall()
+        (location_id, case_code, ts_lo, ts_hi, location_id, case_code, case_code, ts_lo, ts_hi),
+    )
 
     total_in = 0
     total_out = 0
@@ -855,21 +1156,21 @@ def _daily_activity_totals(case_code: str, local_date: str, location_id: int) ->
         ld = _local_date_str_from_ts(e["ts"])
         if ld != local_date:
             continue
-        action = (e["action"] or "").upper()
+        action = sys.intern((e["action"] or "").upper())
         qty = int(e["qty"] or 0)
         qty_in = 0
         qty_out = 0
-        if action == "RECEIVE":
+        if action == ACTION_RECEIVE:
             if e["to_case_code"] == case_code:
                 qty_in = qty
             else:
                 qty_out = qty
-        elif action == "MOVE":
+        elif action == ACTION_MOVE:
             if e["to_case_code"] == case_code:
                 qty_in = qty
             elif e["from_case_code"] == case_code:
                 qty_out = qty
-        elif action == "RETURN":
+        elif action == ACTION_RETURN:
             if e["to_case_code"] == case_code:
                 qty_in = qty
             elif e["from_case_code"] == case_code:
@@ -882,6 +1183,49 @@ def _daily_activity_totals(case_code: str, local_date: str, location_id: int) ->
 
     return total_in, total_out, total_in - total_out
 
+def _item_desc(description: str, item_type: str) -> str:
+    desc = (description or "").strip()
+    return desc or (item_type or "").strip().upper() or "ITEM"
+
+# Activity log handlers: each returns (description, qty_in, qty_out) for one event.
+def _activity_receive(qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type):
+    # goes into New Receipts (case_code may be NR)
+    desc = _item_desc(description, item_type)
+    return (desc, qty, 0) if is_in else (desc, 0, qty)
+
+def _activity_move(qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type):
+    desc = _item_desc(description, item_type)
+    if is_in:
+        return f"FROM {from_cc} - {desc}", qty, 0
+    if is_out:
+        return f"TO {to_cc} - {desc}", 0, qty
+    return desc, 0, 0
+
+def _activity_return(qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type):
+    desc = (brief_desc or "").strip() or _item_desc(description, item_type)
+    if is_in:
+        return desc, qty, 0
+    if is_out:
+        return desc, 0, qty
+    return desc, 0, 0
+
+def _activity_sold(qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type):
+    dept = (dept_no or "").strip()
+    bdesc = (brief_desc or "").strip()
+    return f"{dept} - {bdesc}".strip(" -"), 0, (qty if is_out else 0)
+
+def _activity_missing(qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type):
+    # removes from from_case_code
+    return _item_desc(description, item_type), 0, (qty if is_out else 0)
+
+_ACTION_HANDLERS = {
+    ACTION_RECEIVE: _activity_receive,
+    ACTION_MOVE: _activity_move,
+    ACTION_RETURN: _activity_return,
+    ACTION_SOLD: _activity_sold,
+    ACTION_MISSING: _activity_missing,
+}
+
 def build_daily_activity_workbook(case_code: str, local_date: str, location_id: int):
     """Return an openpyxl workbook for the given case and local_date (YYYY-MM-DD) using MASTER ACTIVITY LOG template."""
     # Load template (relative to project root). Users should keep MASTER ACTIVITY LOG.xlsx next to app folder.
@@ -911,8 +1255,21 @@ def build_daily_activity_workbook(case_code: str, local_date: str, location_id:
 
     # Pull history events for this case and date (store-local)
     # Include events where case is FROM or TO. Exclude counts.
+    ts_lo, ts_hi = _history_ts_window(local_date)
     events = db.execute(
         """
+        SELECT h.id AS id, h.ts AS ts, h.action, h.upc, h.qty, h.from_case_code, h.to_case_code,
+               h.trans_reg, h.dept_no, h.brief_desc, h.ticket_price, h.diamond_test,
+               u.username,
+               COALESCE(p.item_type,'') AS item_type,
+               COALESCE(p.description,'') AS description
+        FROM history h
+        LEFT JOIN users u ON u.id = h.user_id
+        LEFT JOIN products p ON p.upc = h.upc
+        WHERE h.action IN ('RECEIVE','MOVE','SOLD','MISSING','RETURN')
+          AND h.location_id = ? AND h.from_case_code = ?
+          AND h.ts >= ? AND h.ts < ?
+        UNION ALL
         SELECT h.id, h.ts, h.action, h.upc, h.qty, h.from_case_code, h.to_case_code,
                h.trans_reg, h.dept_no, h.brief_desc, h.ticket_price, h.diamond_test,
                u.username,
@@ -922,114 +1279,77 @@ def build_daily_activity_workbook(case_code: str, local_date: str, location_id:
         LEFT JOIN users u ON u.id = h.user_id
         LEFT JOIN products p ON p.upc = h.upc
         WHERE h.action IN ('RECEIVE','MOVE','SOLD','MISSING','RETURN')
-          AND h.location_id = ?
-          AND (h.from_case_code = ? OR h.to_case_code = ?)
-        ORDER BY h.ts ASC, h.id ASC
+          AND h.location_id = ? AND h.to_case_code = ? AND h.from_case_code IS NOT ?
+          AND h.ts >= ? AND h.ts < ?
+        ORDER BY ts ASC, id ASC
         """,
-        (location_id, case_code, case_code),
-    ).fetchall()
-
-    # Filter by local_date in Python to avoid SQLite timezone issues
-    filtered = []
-    for e in events:
-        ld = _local_date_str_from_ts(e["ts"])
-        if ld == local_date:
-            filtered.append(e)
+        (location_id, case_code, ts_lo, ts_hi, location_id, case_code, case_code, ts_lo, ts_hi),
+    )
+    # Stream from the cursor and filter by local_date in Python (avoids SQLite
+    # timezone issues) without materialising the full event list.
+    day_events = (e for e in events if _local_date_str_from_ts(e["ts"]) == local_date)
 
     # Fill rows starting at 10, maintaining merges B:C and D:E if present
     row = 10
-    for e in filtered:
-        ts = e["ts"]
+    # Rows are unpacked positionally; keep in step with the SELECT column order.
+    for (
+        hid, ts, action, upc, qty, from_cc, to_cc,
+        trans_reg, dept_no, brief_desc, ticket_price, diamond_test,
+        username, item_type, description,
+    ) in day_events:
+        action = sys.intern((action or "").upper())
+        qty = int(qty or 0)
+        is_in = to_cc == case_code
+        is_out = from_cc == case_code
+
         dt_local = _parse_iso_to_store(ts) or store_now()
         # DATE (Excel date-only)
         ws.cell(row, 1).value = datetime(dt_local.year, dt_local.month, dt_local.day)
 
-        # ACTION
-        action = (e["action"] or "").upper()
-
         # DOCUMENT # / TRANS/REG (use SYS-id)
-        doc = (e["trans_reg"] or "").strip() if action in ("SOLD", "RETURN") else ""
+        doc = (trans_reg or "").strip() if action in (ACTION_SOLD, ACTION_RETURN) else ""
         if not doc:
-            doc = f"SYS-{e['id']}"
+            doc = f"SYS-{hid}"
         ws.cell(row, 2).value = doc
         # B:C are merged in template; writing B is enough
-        # DEPARTMENT # & BRIEF ITEM DESCRIPTION (D:E merged in template)
-
-        if action == "SOLD":
-            dept = (e["dept_no"] or "").strip()
-            bdesc = (e["brief_desc"] or "").strip()
-            ws.cell(row, 4).value = f"{dept} - {bdesc}".strip(" -")
-        else:
-            desc = ""
-            if action == "RETURN":
-                desc = (e["brief_desc"] or "").strip()
-            if not desc:
-                desc = (e["description"] or "").strip()
-            if not desc:
-                desc = (e["item_type"] or "").strip().upper() or "ITEM"
-            if action == "MOVE":
-                if e["to_case_code"] == case_code:
-                    desc = f"FROM {e['from_case_code']} - {desc}"
-                elif e["from_case_code"] == case_code:
-                    desc = f"TO {e['to_case_code']} - {desc}"
-            ws.cell(row, 4).value = desc
+        # DEPARTMENT # & BRIEF ITEM DESCRIPTION (D:E merged in template) + QTY IN/OUT
+        desc, qty_in, qty_out = _ACTION_HANDLERS.get(action, _activity_missing)(
+            qty, is_in, is_out, from_cc, to_cc, dept_no, brief_desc, description, item_type
+        )
+        ws.cell(row, 4).value = desc
 
         # UPC
-        ws.cell(row, 6).value = e["upc"]
+        ws.cell(row, 6).value = upc
 
         # TICKET PRICE
-        if action == "SOLD":
-            ws.cell(row, 7).value = e["ticket_price"]
-        elif action == "RETURN":
-            ws.cell(row, 7).value = e["ticket_price"]
+        if action == ACTION_SOLD:
+            ws.cell(row, 7).value = ticket_price
+        elif action == ACTION_RETURN:
+            ws.cell(row, 7).value = ticket_price
         else:
             ws.cell(row, 7).value = None
 
         # DIA. TEST
-        if action == "SOLD":
-            ws.cell(row, 8).value = (e["diamond_test"] or "").strip().upper() or None
-        elif action == "RECEIVE":
+        if action == ACTION_SOLD:
+            ws.cell(row, 8).value = (diamond_test or "").strip().upper() or None
+        elif action == ACTION_RECEIVE:
             ws.cell(row, 8).value = "NRT"
-        elif action == "RETURN":
-            ws.cell(row, 8).value = (e["diamond_test"] or "").strip().upper() or None
+        elif action == ACTION_RETURN:
+            ws.cell(row, 8).value = (diamond_test or "").strip().upper() or None
         else:
             ws.cell(row, 8).value = None
 
         # ITEM CODE
-        ws.cell(row, 9).value = _item_code(e["item_type"])
+        ws.cell(row, 9).value = _item_code(item_type)
 
         # REASON CODE
         ws.cell(row, 10).value = _reason_code(action)
 
-        qty = int(e["qty"] or 0)
-        qty_in = 0
-        qty_out = 0
-        if action == "RECEIVE":
-            # goes into New Receipts (case_code may be NR)
-            if e["to_case_code"] == case_code:
-                qty_in = qty
-            else:
-                qty_out = qty
-        elif action == "MOVE":
-            if e["to_case_code"] == case_code:
-                qty_in = qty
-            elif e["from_case_code"] == case_code:
-                qty_out = qty
-        elif action == "RETURN":
-            if e["to_case_code"] == case_code:
-                qty_in = qty
-            elif e["from_case_code"] == case_code:
-                qty_out = qty
-        else:
-            # SOLD/MISSING remove from from_case_code
-            if e["from_case_code"] == case_code:
-                qty_out = qty
-
         ws.cell(row, 11).value = qty_in if qty_in else None
         ws.cell(row, 12).value = qty_out if qty_out else None
 
         # INITIALS (optional)
-        ws.cell(row, 13).value = _initials_from_username(e["username"] or "")
+        ws.cell(row, 13).value = _initials_from_username(username or "")
 
         row += 1
 
@@ -1071,27 +1391,34 @@ def build_daily_count_workbook(case_code: str, local_date: str, location_id: int
     ws[f"Q{start_row}"].value = f"CASE # {case_code}"
 
     db = get_db()
-    previous_count = db.execute(
+    # Latest count for the day and latest count before it, in one round trip.
+    # Partitioning on "is this the report day" keeps several same-day counts
+    # from crowding out the previous day's row.
+    recent_counts = db.execute(
         """
         SELECT *
-        FROM case_counts
-        WHERE case_code=? AND local_date < ? AND location_id=?
-        ORDER BY local_date DESC, id DESC
-        LIMIT 1
+        FROM (
+          SELECT cc.*,
+                 ROW_NUMBER() OVER (
+                   PARTITION BY cc.local_date = ?
+                   ORDER BY cc.local_date DESC, cc.id DESC
+                 ) AS rn
+          FROM case_counts cc
+          WHERE cc.case_code=? AND cc.location_id=? AND cc.local_date <= ?
+        )
+        WHERE rn = 1
+        ORDER BY local_date DESC
         """,
-        (case_code, local_date, location_id),
-    ).fetchone()
+        (local_date, case_code, location_id, local_date),
+    ).fetchall()
 
-    count = db.execute(
-        """
-        SELECT *
-        FROM case_counts
-        WHERE case_code=? AND local_date=? AND location_id=?
-        ORDER BY id DESC
-        LIMIT 1
-        """,
-        (case_code, local_date, location_id),
-    ).fetchone()
+    count = None
+    previous_count = None
+    for r in recent_counts:
+        if r["local_date"] == local_date:
+            count = r
+        else:
+            previous_count = r
 
     if previous_count:
         ws.cell(start_row + 3, 6).value = fmt_mmddyyyy(previous_count["local_date"])
@@ -1146,19 +1473,7 @@ def counts():
     today = local_date_str()
     location_id = current_location_id()
 
-    cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual, c.is_active,
-               COALESCE(SUM(i.qty), 0) AS total_qty,
-               COALESCE(COUNT(DISTINCT i.upc), 0) AS distinct_upcs
-        FROM cases c
-        LEFT JOIN inventory i ON i.case_code = c.case_code AND i.location_id = c.location_id
-        WHERE c.is_active = 1 AND c.location_id = ?
-        GROUP BY c.case_code
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    cases = _case_grid(location_id)
 
     # Latest count per case for today
     counts_rows = db.execute(
@@ -1176,14 +1491,7 @@ def counts():
     ).fetchall()
     counts_map = {r["case_code"]: r for r in counts_rows}
 
-    sys_totals = {
-        c["case_code"]: {
-            "case": case_type_totals(c["case_code"], LOCATION_CASE, location_id),
-            "reserve": case_type_totals(c["case_code"], LOCATION_RESERVE, location_id),
-            "combined": case_type_totals(c["case_code"], location_id=location_id),
-        }
-        for c in cases
-    }
+    sys_totals = case_type_totals_by_case([c["case_code"] for c in cases], location_id)
 
     return render_template(
         "counts.html",
@@ -1284,6 +1592,14 @@ def count_case(case_code: str):
 
 
 # ---------------- History ----------------
+# item_type is taken from products at insert time (the buffer is flushed after
+# the handler's upsert_product calls), so readers don't need the join.
+INSERT_HISTORY_SQL = """
+    INSERT INTO history (ts, user_id, username, action, upc, qty, from_case_code, to_case_code, notes, trans_reg, dept_no, brief_desc, ticket_price, diamond_test, location_id, item_type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT item_type FROM products WHERE upc = ?))
+"""
+
+
 def log_history(
     action: str,
     upc: Optional[str] = None,
@@ -1297,14 +1613,13 @@ def log_history(
     ticket_price: Optional[float] = None,
     diamond_test: Optional[str] = None,
 ):
-    db = get_db()
+    # Rows are buffered for the request and written in one executemany by
+    # _flush_history, inside the same transaction as the inventory change.
     u = current_user()
     location_id = current_location_id()
-    db.execute(
-        """
-        INSERT INTO history (ts, user_id, username, action, upc, qty, from_case_code, to_case_code, notes, trans_reg, dept_no, brief_desc, ticket_price, diamond_test, location_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
+    if "_history_buffer" not in g:
+        g._history_buffer = []
+    g._history_buffer.append(
         (
             utc_now(),
             u.id if u else None,
@@ -1321,8 +1636,28 @@ def log_history(
             ticket_price,
             diamond_test,
             location_id,
-        ),
+            upc,
+        )
     )
+
+
+def _flush_history(db: sqlite3.Connection) -> None:
+    """Write buffered history rows; call right before the handler's db.commit()."""
+    rows = g.pop("_history_buffer", None)
+    if rows:
+        db.executemany(INSERT_HISTORY_SQL, rows)
+
+
+@app.teardown_request
+def flush_history(exception=None):
+    # Safety net for handlers that log without committing themselves.
+    if exception is not None:
+        g.pop("_history_buffer", None)
+        return
+    if "_history_buffer" not in g:
+        return
+    db = get_db()
+    _flush_history(db)
     db.commit()
 
 
@@ -1334,8 +1669,13 @@ def parse_upc_lines(text: str) -> Dict[str, int]:
       - or "UPC,qty"
     Returns aggregated counts by UPC.
     """
+    text = text or ""
+    if "," not in text:
+        # Plain scanner paste: strip/filter/count all run in C via Counter.
+        return dict(Counter(filter(None, map(str.strip, text.splitlines()))))
+
     out: Dict[str, int] = {}
-    for raw in (text or "").splitlines():
+    for raw in text.splitlines():
         line = raw.strip()
         if not line:
             continue
@@ -1360,13 +1700,23 @@ def parse_upc_lines(text: str) -> Dict[str, int]:
 
 # ---------------- Inventory operations ----------------
 def ensure_case_exists(case_code: str) -> bool:
-    db = get_db()
+    # Active case codes are loaded once per request per location; handlers that
+    # check both a source and destination case reuse the same set.
     location_id = current_location_id()
-    row = db.execute(
-        "SELECT case_code FROM cases WHERE case_code=? AND is_active=1 AND location_id=?",
-        (case_code, location_id),
-    ).fetchone()
-    return bool(row)
+    if "_case_sets" not in g:
+        g._case_sets = {}
+    case_set = g._case_sets.get(location_id)
+    if case_set is None:
+        db = get_db()
+        case_set = {
+            r["case_code"]
+            for r in db.execute(
+                "SELECT case_code FROM cases WHERE is_active=1 AND location_id=?",
+                (location_id,),
+            )
+        }
+        g._case_sets[location_id] = case_set
+    return case_code in case_set
 
 
 def upsert_product(upc: str, description: Optional[str], item_type: Optional[str] = None):
@@ -1387,6 +1737,12 @@ def upsert_product(upc: str, description: Optional[str], item_type: Optional[str
             sets = ", ".join([f"{k}=?" for k in updates.keys()])
             params = list(updates.values()) + [upc]
             db.execute(f"UPDATE products SET {sets} WHERE upc=?", params)
+            if "item_type" in updates:
+                # Earlier history rows were logged before the type was known.
+                db.execute(
+                    "UPDATE history SET item_type=? WHERE upc=? AND item_type IS NULL",
+                    (item_type, upc),
+                )
     else:
         db.execute(
             "INSERT INTO products (upc, description, item_type) VALUES (?, ?, ?)",
@@ -1394,6 +1750,42 @@ def upsert_product(upc: str, description: Optional[str], item_type: Optional[str
         )
 
 
+def upsert_products(upcs, description: Optional[str], item_type: Optional[str] = None):
+    """
+    Batch form of upsert_product: one executemany upsert for many UPCs sharing
+    the same description/item_type. Existing values are only filled in when
+    missing, never overwritten. With nothing to fill in it does nothing, so
+    callers must already have product rows (e.g. UPCs taken from inventory).
+    """
+    if item_type and item_type not in ALLOWED_ITEM_TYPES:
+        item_type = None
+    if not description and not item_type:
+        return
+    upcs = list(upcs)
+    db = get_db()
+    db.executemany(
+        """
+        INSERT INTO products (upc, description, item_type) VALUES (?, ?, ?)
+        ON CONFLICT(upc) DO UPDATE SET
+            description = CASE
+                WHEN COALESCE(excluded.description, '') <> '' AND COALESCE(products.description, '') = ''
+                THEN excluded.description ELSE products.description END,
+            item_type = CASE
+                WHEN COALESCE(excluded.item_type, '') <> '' AND COALESCE(products.item_type, '') = ''
+                THEN excluded.item_type ELSE products.item_type END
+        WHERE (COALESCE(excluded.description, '') <> '' AND COALESCE(products.description, '') = '')
+           OR (COALESCE(excluded.item_type, '') <> '' AND COALESCE(products.item_type, '') = '')
+        """,
+        [(upc, description, item_type) for upc in upcs],
+    )
+    if item_type:
+        # Same as upsert_product: earlier history rows pick up a newly known type.
+        db.executemany(
+            "UPDATE history SET item_type=? WHERE upc=? AND item_type IS NULL",
+            [(item_type, upc) for upc in upcs],
+        )
+
+
 def add_qty(
     case_code: str,
     upc: str,
@@ -1455,79 +1847,425 @@ def remove_qty(
 
 
 
-def case_order_sql() -> str:
-    # numeric sort for '01'..'30'
-    # expects cases table is aliased as 'c'
-    return """
-      ORDER BY
-        c.is_virtual DESC,
-        CASE
-          WHEN c.case_code GLOB '[0-9]*' THEN CAST(c.case_code AS INTEGER)
-          ELSE 999999
-        END,
-        c.case_code
-    """
-def _validate_have_qty(
+def begin_immediate(db: sqlite3.Connection) -> None:
+    # Take the write lock before the first write so a bulk post's UPDATEs run as one transaction.
+    # Validation runs before this, so concurrent changes are caught by remove_qty_many's
+    # guarded `qty >= ?` UPDATE and rowcount check, not by this lock.
+    if not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE")
+
+
+def add_qty_many(
     case_code: str,
     upc_map: Dict[str, int],
     location: str = LOCATION_CASE,
     location_id: Optional[int] = None,
-) -> list[str]:
+):
+    """Batch form of add_qty: one executemany upsert for every UPC in upc_map."""
     db = get_db()
     location_id = location_id or current_location_id()
     if not location_id:
         raise ValueError("location_id is required for inventory updates")
     if location not in INVENTORY_LOCATIONS:
         location = LOCATION_CASE
-    problems = []
-    for upc, need in upc_map.items():
-        row = db.execute(
-            "SELECT qty FROM inventory WHERE case_code=? AND location_id=? AND upc=? AND location=?",
-            (case_code, location_id, upc, location),
-        ).fetchone()
-        have = int(row["qty"]) if row else 0
-        if have < need:
-            problems.append(f"{upc}: need {need}, have {have}")
-    return problems
+    db.executemany(
+        """
+        INSERT INTO inventory (case_code, location_id, upc, location, qty)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(case_code, location_id, upc, location) DO UPDATE SET qty = qty + excluded.qty
+        """,
+        [(case_code, location_id, upc, location, qty) for upc, qty in upc_map.items()],
+    )
 
 
-def case_type_totals(
+def remove_qty_many(
     case_code: str,
-    location: Optional[str] = None,
+    upc_map: Dict[str, int],
+    location: str = LOCATION_CASE,
     location_id: Optional[int] = None,
-) -> dict:
-    """Compute live totals for a case, grouped by item_type."""
+) -> bool:
+    """
+    Batch form of remove_qty. Returns False (and changes nothing the caller
+    can't roll back) if any UPC no longer has enough qty on hand.
+    """
     db = get_db()
     location_id = location_id or current_location_id()
     if not location_id:
-        raise ValueError("location_id is required for inventory lookups")
-    pieces = []
-    params = []
-    for category in ITEM_CATEGORIES:
-        pieces.append(
-            f"COALESCE(SUM(CASE WHEN p.item_type=? THEN inv.qty ELSE 0 END),0) AS {category['count_key']}"
-        )
-        params.append(category["name"])
-    pieces.append("COALESCE(SUM(inv.qty),0) AS total")
-    pieces.append("COALESCE(SUM(CASE WHEN p.item_type IS NULL OR p.item_type='' THEN inv.qty ELSE 0 END),0) AS unknown")
-    sql = f"""
-        SELECT
-          {", ".join(pieces)}
-        FROM inventory inv
-        LEFT JOIN products p ON p.upc = inv.upc
-        WHERE inv.case_code = ? AND inv.location_id = ?
+        raise ValueError("location_id is required for inventory updates")
+    if location not in INVENTORY_LOCATIONS:
+        location = LOCATION_CASE
+    cur = db.executemany(
         """
-    params.append(case_code)
-    params.append(location_id)
-    if location in INVENTORY_LOCATIONS:
-        sql += " AND inv.location = ?"
-        params.append(location)
-    row = db.execute(sql, params).fetchone()
-    base = {c["count_key"]: 0 for c in ITEM_CATEGORIES}
+        UPDATE inventory SET qty = qty - ?
+        WHERE case_code=? AND location_id=? AND upc=? AND location=? AND qty >= ?
+        """,
+        [(qty, case_code, location_id, upc, location, qty) for upc, qty in upc_map.items()],
+    )
+    if cur.rowcount != len(upc_map):
+        return False
+    db.execute(
+        "DELETE FROM inventory WHERE location_id=? AND case_code=? AND location=? AND qty <= 0",
+        (location_id, case_code, location),
+    )
+    return True
+
+
+
+# numeric sort for '01'..'30'
+# expects cases table is aliased as 'c'
+CASE_ORDER_SQL = """
+      ORDER BY
+        c.is_virtual DESC,
+        CASE
+          WHEN c.case_code GLOB '[0-9]*' THEN CAST(c.case_code AS INTEGER)
+          ELSE 999999
+        END,
+        c.case_code
+"""
+
+
+# Hot read queries, built once at import so every request hands sqlite3 the
+# identical string and hits the connection's statement cache.
+SQL_ACTIVE_CASES = f"""
+    SELECT c.case_code, c.case_name, c.is_virtual
+    FROM cases c
+    WHERE c.is_active=1 AND c.location_id=?
+    {CASE_ORDER_SQL}
+"""
+
+SQL_CASE_GRID = f"""
+    SELECT c.case_code, c.case_name, c.is_virtual, c.is_active,
+           COALESCE(t.total_qty, 0) AS total_qty,
+           COALESCE(t.distinct_upcs, 0) AS distinct_upcs
+    FROM cases c
+    LEFT JOIN case_totals t ON t.case_code = c.case_code AND t.location_id = c.location_id
+    WHERE c.is_active = 1 AND c.location_id = ?
+    {CASE_ORDER_SQL}
+"""
+
+# idx_inv_loc_case (location_id, case_code, location, upc, qty) covers this and
+# already yields rows in upc order, so the ORDER BY costs no sort; keep upc right
+# after the equality columns if that index changes.
+SQL_CASE_ITEMS = """
+    SELECT inv.upc, inv.qty, p.description, p.item_type
+    FROM inventory inv
+    LEFT JOIN products p ON p.upc = inv.upc
+    WHERE inv.case_code = ? AND inv.location_id = ? AND inv.location = ?
+    ORDER BY inv.upc
+"""
+
+# Both locations in one pass for the case page; the same index returns CASE rows
+# then RESERVE rows, each in upc order.
+SQL_CASE_ALL_ITEMS = """
+    SELECT inv.location, inv.upc, inv.qty, p.description, p.item_type
+    FROM inventory inv
+    LEFT JOIN products p ON p.upc = inv.upc
+    WHERE inv.location_id = ? AND inv.case_code = ? AND inv.location IN ('CASE', 'RESERVE')
+    ORDER BY inv.location, inv.upc
+"""
+
+SQL_RECENT_HISTORY = """
+    SELECT h.*
+    FROM history h
+    WHERE h.location_id = ?
+    ORDER BY h.id DESC
+    LIMIT 25
+"""
+
+# OR on from/to defeats the per-side indexes; UNION ALL lets each branch seek.
+# Both branches come back in id DESC index order, so SQLite merges them and
+# stops at the LIMIT without a sort (no outer SELECT * wrapper needed).
+# Paged by keyset: "id < ?" picks up below the last row already shown.
+SQL_CASE_HISTORY = """
+    SELECT h.*
+    FROM history h
+    WHERE h.location_id = ? AND h.from_case_code = ? AND h.id < ?
+    UNION ALL
+    SELECT h.*
+    FROM history h
+    WHERE h.location_id = ? AND h.to_case_code = ? AND h.from_case_code IS NOT ? AND h.id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+CASE_HISTORY_PAGE_SIZE = 150
+HISTORY_PAGE_SIZE = 500
+HISTORY_ID_MAX = 2**63 - 1  # first page: no keyset bound
+HISTORY_EXPORT_LIMIT = 5000
+
+# Export-ready history/count columns (tuple rows straight into csv.writer)
+HISTORY_EXPORT_COLUMNS = """
+    h.ts, COALESCE(h.username,''), h.action, COALESCE(h.upc,''),
+    COALESCE(h.item_type,''), COALESCE(NULLIF(h.qty,0),''),
+    COALESCE(h.from_case_code,''), COALESCE(h.to_case_code,''), COALESCE(h.notes,''),
+    COALESCE(h.trans_reg,''), COALESCE(h.dept_no,''), COALESCE(h.brief_desc,''),
+    COALESCE(h.ticket_price,''),
+    COALESCE(h.diamond_test,'')
+"""
+COUNTS_EXPORT_COLUMNS = """
+    ts_utc, local_date, case_code, COALESCE(username,''),
+    bracelets, rings, earrings, necklaces, other,
+    reserve_bracelets, reserve_rings, reserve_earrings,
+    reserve_necklaces, reserve_other,
+    total,
+    COALESCE(notes,'')
+"""
+
+
+def _history_events_sql(columns: str, has_case: bool, has_upc: bool, has_action: bool, has_after: bool) -> str:
+    """
+    History event list, newest first. Params: location_id, [case_code],
+    then upc/action/after_id as flagged (repeated per UNION ALL branch), then the limit.
+    """
+    filters = ""
+    if has_upc:
+        filters += " AND h.upc=?"
+    if has_action:
+        filters += " AND h.action LIKE ?"
+    if has_after:
+        filters += " AND h.id < ?"
+    if not has_case:
+        return f"SELECT {columns} FROM history h WHERE h.location_id=?{filters} ORDER BY h.id DESC LIMIT ?"
+    # Same from/to UNION ALL split as SQL_CASE_HISTORY, so each side seeks its index
+    matched = f"""
+        SELECT h.* FROM history h
+        WHERE h.location_id=? AND h.from_case_code=?{filters}
+        UNION ALL
+        SELECT h.* FROM history h
+        WHERE h.location_id=? AND h.to_case_code=? AND h.from_case_code IS NOT ?{filters}
+        ORDER BY id DESC LIMIT ?
+    """
+    if columns == "h.*":
+        return matched
+    # Limit first; the outer select only formats the matched rows
+    return f"SELECT {columns} FROM ({matched}) h ORDER BY h.id DESC"
+
+
+def _counts_sql(columns: str, has_case: bool, has_date: bool) -> str:
+    sql = f"SELECT {columns} FROM case_counts WHERE location_id=?"
+    if has_case:
+        sql += " AND case_code=?"
+    if has_date:
+        sql += " AND local_date=?"
+    return sql + " ORDER BY id DESC LIMIT ?"
+
+
+# Every filter combination is built once, so each request reuses identical SQL
+# text (and sqlite3's statement cache). Keys: (case, upc, action, after_id) / (case, date).
+_HISTORY_SQLS = {
+    flags: _history_events_sql("h.*", *flags) for flags in itertools.product((False, True), repeat=4)
+}
+_HISTORY_EXPORT_SQLS = {
+    flags: _history_events_sql(HISTORY_EXPORT_COLUMNS, *flags) for flags in itertools.product((False, True), repeat=4)
+}
+_COUNTS_SQLS = {flags: _counts_sql("*", *flags) for flags in itertools.product((False, True), repeat=2)}
+_COUNTS_EXPORT_SQLS = {
+    flags: _counts_sql(COUNTS_EXPORT_COLUMNS, *flags) for flags in itertools.product((False, True), repeat=2)
+}
+
+
+def _history_query(
+    location_id: int,
+    report_type: str,
+    case_code: str,
+    upc: str,
+    action: str,
+    date: str,
+    limit: int,
+    after_id: Optional[int] = None,
+    export: bool = False,
+) -> Tuple[str, list]:
+    """SQL and params for the /history lists and their CSV exports (export=True: tuple-ready columns)."""
+    if report_type == "counts":
+        sqls = _COUNTS_EXPORT_SQLS if export else _COUNTS_SQLS
+        return sqls[(bool(case_code), bool(date))], [location_id, *(v for v in (case_code, date) if v), limit]
+
+    sqls = _HISTORY_EXPORT_SQLS if export else _HISTORY_SQLS
+    sql = sqls[(bool(case_code), bool(upc), bool(action), bool(after_id))]
+    filter_params = [v for v in (upc, action, after_id) if v]
+    if case_code:
+        params = [location_id, case_code, *filter_params, location_id, case_code, case_code, *filter_params]
+    else:
+        params = [location_id, *filter_params]
+    params.append(limit)
+    return sql, params
+
+
+def _after_id_arg() -> Optional[int]:
+    """Keyset cursor from ?after_id= (the id of the last row already shown)."""
+    raw = (request.args.get("after_id") or "").strip()
+    return int(raw) if raw.isdigit() and int(raw) > 0 else None
+
+
+def _case_history_page(db: sqlite3.Connection, location_id: int, case_code: str, after_id: Optional[int] = None) -> list:
+    before_id = after_id or HISTORY_ID_MAX
+    return db.execute(
+        SQL_CASE_HISTORY,
+        (location_id, case_code, before_id, location_id, case_code, case_code, before_id, CASE_HISTORY_PAGE_SIZE),
+    ).fetchall()
+
+
+def data_version() -> int:
+    """
+    Newest history id. Inventory moves, case create/rename/delete and product
+    upserts all log history in the same transaction, so this changes with any
+    data the case caches hold, and every worker process reads the same value.
+    """
+    return get_db().execute("SELECT MAX(id) FROM history").fetchone()[0] or 0
+
+
+# SimpleCache is per process: keying the memos on data_version() keeps other
+# workers from serving a list that was cached before someone else's commit.
+# The version is read before the rows, so an entry is never older than its key.
+@cache.memoize(timeout=300)
+def _active_cases_at(location_id: int, version: int) -> list[dict]:
+    db = get_db()
+    rows = db.execute(SQL_ACTIVE_CASES, (location_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+@cache.memoize(timeout=60)
+def _case_grid_at(location_id: int, version: int) -> list[dict]:
+    db = get_db()
+    rows = db.execute(SQL_CASE_GRID, (location_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def _active_cases(location_id: int) -> list[dict]:
+    """Active cases for a location in grid order (case pickers)."""
+    return _active_cases_at(location_id, data_version())
+
+
+def _case_grid(location_id: int) -> list[dict]:
+    """Active cases with unit/UPC totals for the case grid."""
+    return _case_grid_at(location_id, data_version())
+
+
+def invalidate_case_cache(location_id: Optional[int], cases_changed: bool = False) -> None:
+    # Entries under older versions are unreachable already; drop them from this process
+    cache.delete_memoized(_case_grid_at)
+    if cases_changed:
+        cache.delete_memoized(_active_cases_at)
+        g.pop("_case_sets", None)
+
+
+VALIDATE_BATCH_SIZE = 500
+
+
+def _validate_have_qty(
+    case_code: str,
+    upc_map: Dict[str, int],
+    location: str = LOCATION_CASE,
+    location_id: Optional[int] = None,
+) -> list[str]:
+    db = get_db()
+    location_id = location_id or current_location_id()
+    if not location_id:
+        raise ValueError("location_id is required for inventory updates")
+    if location not in INVENTORY_LOCATIONS:
+        location = LOCATION_CASE
+    # One IN (...) lookup per batch instead of a SELECT per UPC; batches keep
+    # large pastes under SQLite's bound-parameter limit.
+    upcs = list(upc_map)
+    have_by_upc: Dict[str, int] = {}
+    for i in range(0, len(upcs), VALIDATE_BATCH_SIZE):
+        batch = upcs[i:i + VALIDATE_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        for upc, qty in db.execute(
+            f"""
+            SELECT upc, qty FROM inventory
+            WHERE location_id=? AND case_code=? AND location=? AND upc IN ({placeholders})
+            """,
+            (location_id, case_code, location, *batch),
+        ):
+            have_by_upc[upc] = int(qty)
+    problems = []
+    for upc, need in upc_map.items():
+        have = have_by_upc.get(upc, 0)
+        if have < need:
+            problems.append(f"{upc}: need {need}, have {have}")
+    return problems
+
+
+def case_type_totals(
+    case_code: str,
+    location: Optional[str] = None,
+    location_id: Optional[int] = None,
+) -> dict:
+    """Compute live totals for a case, grouped by item_type."""
+    db = get_db()
+    location_id = location_id or current_location_id()
+    if not location_id:
+        raise ValueError("location_id is required for inventory lookups")
+    pieces = []
+    params = []
+    for category in ITEM_CATEGORIES:
+        pieces.append(
+            f"COALESCE(SUM(CASE WHEN p.item_type=? THEN inv.qty ELSE 0 END),0) AS {category['count_key']}"
+        )
+        params.append(category["name"])
+    pieces.append("COALESCE(SUM(inv.qty),0) AS total")
+    pieces.append("COALESCE(SUM(CASE WHEN p.item_type IS NULL OR p.item_type='' THEN inv.qty ELSE 0 END),0) AS unknown")
+    sql = f"""
+        SELECT
+          {", ".join(pieces)}
+        FROM inventory inv
+        LEFT JOIN products p ON p.upc = inv.upc
+        WHERE inv.case_code = ? AND inv.location_id = ?
+        """
+    params.append(case_code)
+    params.append(location_id)
+    if location in INVENTORY_LOCATIONS:
+        sql += " AND inv.location = ?"
+        params.append(location)
+    row = db.execute(sql, params).fetchone()
+    base = {c["count_key"]: 0 for c in ITEM_CATEGORIES}
     base.update({"total": 0, "unknown": 0})
     return dict(row) if row else base
 
 
+_COUNT_KEY_BY_ITEM_TYPE = {c["name"]: c["count_key"] for c in ITEM_CATEGORIES}
+
+
+def _empty_type_totals() -> dict:
+    base = {c["count_key"]: 0 for c in ITEM_CATEGORIES}
+    base.update({"total": 0, "unknown": 0})
+    return base
+
+
+def _add_type_qty(bucket: dict, item_type: Optional[str], qty: int) -> None:
+    # Same bucketing as case_type_totals: blank item_type counts as unknown
+    bucket["total"] += qty
+    key = _COUNT_KEY_BY_ITEM_TYPE.get(item_type)
+    if key:
+        bucket[key] += qty
+    elif not item_type:
+        bucket["unknown"] += qty
+
+
+def case_type_totals_by_case(case_codes, location_id: int) -> dict:
+    """Live item_type totals for many cases at once, keyed by case_code then case/reserve/combined."""
+    db = get_db()
+    # products is small; one dict replaces a LEFT JOIN per case
+    item_types = {r["upc"]: r["item_type"] for r in db.execute("SELECT upc, item_type FROM products")}
+
+    out = {
+        code: {"case": _empty_type_totals(), "reserve": _empty_type_totals(), "combined": _empty_type_totals()}
+        for code in case_codes
+    }
+    rows = db.execute(
+        "SELECT case_code, location, upc, qty FROM inventory WHERE location_id = ?",
+        (location_id,),
+    )
+    for r in rows:
+        buckets = out.get(r["case_code"])
+        if buckets is None:
+            continue
+        item_type = item_types.get(r["upc"])
+        _add_type_qty(buckets[r["location"].lower()], item_type, r["qty"])
+        _add_type_qty(buckets["combined"], item_type, r["qty"])
+    return out
+
+
 
 # ---------------- Setup/Login ----------------
 @app.route("/setup", methods=["GET", "POST"])
@@ -1688,6 +2426,7 @@ def locations_admin():
             (returns_code, location_id, RETURNS_NAME, utc_now()),
         )
         db.commit()
+        invalidate_case_cache(location_id, cases_changed=True)
         flash("Location created.", "success")
         return redirect(url_for("locations_admin"))
 
@@ -1704,33 +2443,11 @@ def locations_admin():
 @app.route("/")
 @login_required
 def index():
-    db = get_db()
+    db = get_read_db()
     location_id = current_location_id()
-    cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual, c.is_active,
-               COALESCE(SUM(i.qty), 0) AS total_qty,
-               COALESCE(COUNT(DISTINCT i.upc), 0) AS distinct_upcs
-        FROM cases c
-        LEFT JOIN inventory i ON i.case_code = c.case_code AND i.location_id = c.location_id
-        WHERE c.is_active = 1 AND c.location_id = ?
-        GROUP BY c.case_code
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    cases = _case_grid(location_id)
 
-    recent = db.execute(
-        """
-        SELECT h.*, p.item_type
-        FROM history h
-        LEFT JOIN products p ON p.upc = h.upc
-        WHERE h.location_id = ?
-        ORDER BY h.id DESC
-        LIMIT 25
-        """,
-        (location_id,),
-    ).fetchall()
+    recent = db.execute(SQL_RECENT_HISTORY, (location_id,)).fetchall()
 
     return render_template("index.html", cases=cases, recent=recent, user=current_user())
 
@@ -1756,8 +2473,10 @@ def create_case():
             "INSERT INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at) VALUES (?,?,?,?,?,?)",
             (case_code, location_id, case_name, 0, 1, utc_now()),
         )
-        db.commit()
         log_history(ACTION_CASE_CREATE, notes=f"Created case {case_code} ({case_name})")
+        _flush_history(db)
+        db.commit()
+        invalidate_case_cache(location_id, cases_changed=True)
         flash(f"Case {case_code} created.", "success")
     except sqlite3.IntegrityError:
         flash("That case number already exists.", "danger")
@@ -1769,7 +2488,7 @@ def create_case():
 @login_required
 def view_case(case_code: str):
     case_code = (case_code or "").strip()
-    db = get_db()
+    db = get_read_db()
     location_id = current_location_id()
 
     case = db.execute(
@@ -1780,58 +2499,29 @@ def view_case(case_code: str):
         flash("Case not found.", "danger")
         return redirect(url_for("index"))
 
-    case_items = db.execute(
-        """
-        SELECT inv.upc, inv.qty, p.description, p.item_type
-        FROM inventory inv
-        LEFT JOIN products p ON p.upc = inv.upc
-        WHERE inv.case_code = ? AND inv.location_id = ? AND inv.location = ?
-        ORDER BY inv.upc
-        """,
-        (case_code, location_id, LOCATION_CASE),
-    ).fetchall()
-
-    reserve_items = db.execute(
-        """
-        SELECT inv.upc, inv.qty, p.description, p.item_type
-        FROM inventory inv
-        LEFT JOIN products p ON p.upc = inv.upc
-        WHERE inv.case_code = ? AND inv.location_id = ? AND inv.location = ?
-        ORDER BY inv.upc
-        """,
-        (case_code, location_id, LOCATION_RESERVE),
-    ).fetchall()
-
-    totals = db.execute(
-        """
-        SELECT COALESCE(SUM(qty),0) AS total_qty, COALESCE(COUNT(DISTINCT upc),0) AS distinct_upcs
-        FROM inventory
-        WHERE case_code=? AND location_id=?
-        """,
-        (case_code, location_id),
-    ).fetchone()
-
-    case_totals = db.execute(
-        """
-        SELECT COALESCE(SUM(qty),0) AS total_qty, COALESCE(COUNT(DISTINCT upc),0) AS distinct_upcs
-        FROM inventory
-        WHERE case_code=? AND location_id=? AND location=?
-        """,
-        (case_code, location_id, LOCATION_CASE),
-    ).fetchone()
-
-    reserve_totals = db.execute(
-        """
-        SELECT COALESCE(SUM(qty),0) AS total_qty, COALESCE(COUNT(DISTINCT upc),0) AS distinct_upcs
-        FROM inventory
-        WHERE case_code=? AND location_id=? AND location=?
-        """,
-        (case_code, location_id, LOCATION_RESERVE),
-    ).fetchone()
-
-    case_type_totals_data = case_type_totals(case_code, LOCATION_CASE, location_id)
-    reserve_type_totals = case_type_totals(case_code, LOCATION_RESERVE, location_id)
-    combined_type_totals = case_type_totals(case_code, location_id=location_id)
+    case_items = []
+    reserve_items = []
+    for r in db.execute(SQL_CASE_ALL_ITEMS, (location_id, case_code)):
+        (case_items if r["location"] == LOCATION_CASE else reserve_items).append(r)
+
+    # Totals come straight from the item rows above (one row per UPC per
+    # location) instead of separate aggregate queries.
+    case_type_totals_data = _empty_type_totals()
+    reserve_type_totals = _empty_type_totals()
+    combined_type_totals = _empty_type_totals()
+    for r in case_items:
+        _add_type_qty(case_type_totals_data, r["item_type"], r["qty"])
+        _add_type_qty(combined_type_totals, r["item_type"], r["qty"])
+    for r in reserve_items:
+        _add_type_qty(reserve_type_totals, r["item_type"], r["qty"])
+        _add_type_qty(combined_type_totals, r["item_type"], r["qty"])
+
+    case_totals = {"total_qty": case_type_totals_data["total"], "distinct_upcs": len(case_items)}
+    reserve_totals = {"total_qty": reserve_type_totals["total"], "distinct_upcs": len(reserve_items)}
+    totals = {
+        "total_qty": combined_type_totals["total"],
+        "distinct_upcs": len({r["upc"] for r in case_items} | {r["upc"] for r in reserve_items}),
+    }
 
     # Latest physical count for today (store-local)
     today = local_date_str()
@@ -1847,27 +2537,10 @@ def view_case(case_code: str):
     ).fetchone()
 
 
-    history_rows = db.execute(
-        """
-        SELECT h.*, p.item_type
-        FROM history h
-        LEFT JOIN products p ON p.upc = h.upc
-        WHERE h.location_id = ? AND (h.from_case_code = ? OR h.to_case_code = ?)
-        ORDER BY id DESC
-        LIMIT 150
-        """,
-        (location_id, case_code, case_code),
-    ).fetchall()
+    history_rows = _case_history_page(db, location_id, case_code, _after_id_arg())
+    history_next_id = history_rows[-1]["id"] if len(history_rows) == CASE_HISTORY_PAGE_SIZE else None
 
-    active_cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual
-        FROM cases c
-        WHERE c.is_active=1 AND c.location_id=?
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    active_cases = _active_cases(location_id)
 
     return render_template(
         "case.html",
@@ -1882,6 +2555,7 @@ def view_case(case_code: str):
         combined_type_totals=combined_type_totals,
         last_count=last_count,
         history=history_rows,
+        history_next_id=history_next_id,
         active_cases=active_cases,
         count_categories=COUNT_CATEGORIES,
         user=current_user(),
@@ -1901,28 +2575,45 @@ def api_case_items(case_code: str):
         location = LOCATION_CASE
     location_id = current_location_id()
 
-    db = get_db()
-    rows = db.execute(
-        """
-        SELECT inv.upc, inv.qty, p.description, p.item_type
-        FROM inventory inv
-        LEFT JOIN products p ON p.upc = inv.upc
-        WHERE inv.case_code = ? AND inv.location_id = ? AND inv.location = ?
-        ORDER BY inv.upc
-        """,
-        (case_code, location_id, location),
-    ).fetchall()
+    db = get_read_db()
+    cur = db.execute(SQL_CASE_ITEMS, (case_code, location_id, location))
+
+    # Build the payload straight off the cursor (columns: upc, qty, description, item_type).
+    items = [
+        {"upc": r[0], "qty": int(r[1]), "description": r[2] or "", "item_type": r[3] or ""}
+        for r in cur
+    ]
+    payload = {"ok": True, "case_code": case_code, "location": location, "items": items}
+    return Response(orjson.dumps(payload), mimetype="application/json")
+
 
+@app.get("/api/case/<case_code>/history")
+@login_required
+def api_case_history(case_code: str):
+    case_code = (case_code or "").strip()
+    if not ensure_case_exists(case_code):
+        return jsonify({"ok": False, "error": "Case not found"}), 404
+    location_id = current_location_id()
+
+    rows = _case_history_page(get_read_db(), location_id, case_code, _after_id_arg())
     items = [
         {
-            "upc": r["upc"],
-            "qty": int(r["qty"]),
-            "description": r["description"] or "",
+            "id": r["id"],
+            "ts": fmt_local_ts(r["ts"]),
+            "username": r["username"] or "",
+            "action": r["action"],
+            "upc": r["upc"] or "",
             "item_type": r["item_type"] or "",
+            "qty": r["qty"] or "",
+            "from_case_code": r["from_case_code"] or "",
+            "to_case_code": r["to_case_code"] or "",
+            "notes": r["notes"] or "",
         }
         for r in rows
     ]
-    return jsonify({"ok": True, "case_code": case_code, "location": location, "items": items})
+    next_after_id = rows[-1]["id"] if len(rows) == CASE_HISTORY_PAGE_SIZE else None
+    payload = {"ok": True, "case_code": case_code, "items": items, "next_after_id": next_after_id}
+    return Response(orjson.dumps(payload), mimetype="application/json")
 
 
 @app.get("/cases/<case_code>/edit")
@@ -1974,9 +2665,11 @@ def edit_case_post(case_code: str):
         "UPDATE cases SET case_name=? WHERE case_code=? AND location_id=?",
         (new_name, case_code, location_id),
     )
+    log_history(ACTION_CASE_EDIT, notes=f"Renamed case {case_code}: '{old_name}' → '{new_name}'")
+    _flush_history(db)
     db.commit()
+    invalidate_case_cache(location_id, cases_changed=True)
 
-    log_history(ACTION_CASE_EDIT, notes=f"Renamed case {case_code}: '{old_name}' → '{new_name}'")
     flash(f"Case {case_code} renamed.", "success")
     return redirect(url_for("view_case", case_code=case_code))
 
@@ -1992,16 +2685,12 @@ def delete_case(case_code: str):
         return redirect(url_for("index"))
 
     db = get_db()
-    cnt = db.execute(
-        """
-        SELECT COALESCE(SUM(i.qty),0) AS t
-        FROM inventory i
-        JOIN cases c ON c.case_code = i.case_code AND c.location_id = i.location_id
-        WHERE i.case_code=? AND i.location_id=?
-        """,
-        (case_code, location_id),
-    ).fetchone()["t"]
-    if cnt and int(cnt) > 0:
+    # case_totals holds one trigger-maintained row per case (CASE + RESERVE).
+    row = db.execute(
+        "SELECT total_qty FROM case_totals WHERE location_id=? AND case_code=?",
+        (location_id, case_code),
+    ).fetchone()
+    if row and int(row["total_qty"]) > 0:
         flash("Case must be empty before deletion. Move items out first.", "danger")
         return redirect(url_for("view_case", case_code=case_code))
 
@@ -2009,8 +2698,10 @@ def delete_case(case_code: str):
         "UPDATE cases SET is_active=0 WHERE case_code=? AND location_id=?",
         (case_code, location_id),
     )
-    db.commit()
     log_history(ACTION_CASE_DELETE, notes=f"Deleted/archived case {case_code}")
+    _flush_history(db)
+    db.commit()
+    invalidate_case_cache(location_id, cases_changed=True)
     flash(f"Case {case_code} deleted (archived).", "success")
     return redirect(url_for("index"))
 
@@ -2042,13 +2733,18 @@ def move_out_of_case(case_code: str):
         return redirect(url_for("view_case", case_code=case_code))
 
     db = get_db()
+    begin_immediate(db)
+    if not remove_qty_many(case_code, upc_map, LOCATION_CASE):
+        db.rollback()
+        flash(INVENTORY_CHANGED_MSG, "danger")
+        return redirect(url_for("view_case", case_code=case_code))
+    upsert_products(upc_map, description)
+    add_qty_many(to_case, upc_map, LOCATION_CASE)
     for upc, qty in upc_map.items():
-        upsert_product(upc, description, item_type=None)
-        ok, _ = remove_qty(case_code, upc, qty, LOCATION_CASE)
-        if ok:
-            add_qty(to_case, upc, qty, LOCATION_CASE)
-            log_history(ACTION_MOVE, upc=upc, qty=qty, from_case_code=case_code, to_case_code=to_case, notes="Moved from case workbench")
+        log_history(ACTION_MOVE, upc=upc, qty=qty, from_case_code=case_code, to_case_code=to_case, notes="Moved from case workbench")
+    _flush_history(db)
     db.commit()
+    invalidate_case_cache(current_location_id())
 
     flash(f"Moved {sum(upc_map.values())} unit(s) from {case_code} → {to_case}.", "success")
     return redirect(url_for("view_case", case_code=to_case))
@@ -2081,19 +2777,24 @@ def transfer_case_location(case_code: str):
         return redirect(url_for("view_case", case_code=case_code))
 
     db = get_db()
+    begin_immediate(db)
+    if not remove_qty_many(case_code, upc_map, from_location):
+        db.rollback()
+        flash(INVENTORY_CHANGED_MSG, "danger")
+        return redirect(url_for("view_case", case_code=case_code))
+    add_qty_many(case_code, upc_map, to_location)
     for upc, qty in upc_map.items():
-        ok, _ = remove_qty(case_code, upc, qty, from_location)
-        if ok:
-            add_qty(case_code, upc, qty, to_location)
-            log_history(
-                ACTION_MOVE,
-                upc=upc,
-                qty=qty,
-                from_case_code=case_code,
-                to_case_code=case_code,
-                notes=f"Moved {from_location} → {to_location} (case workbench)",
-            )
+        log_history(
+            ACTION_MOVE,
+            upc=upc,
+            qty=qty,
+            from_case_code=case_code,
+            to_case_code=case_code,
+            notes=f"Moved {from_location} → {to_location} (case workbench)",
+        )
+    _flush_history(db)
     db.commit()
+    invalidate_case_cache(current_location_id())
 
     flash(f"Moved {sum(upc_map.values())} unit(s) {from_location} → {to_location} for case {case_code}.", "success")
     return redirect(url_for("view_case", case_code=case_code))
@@ -2147,22 +2848,27 @@ def sell_from_case(case_code: str):
         return redirect(url_for("view_case", case_code=case_code))
 
     db = get_db()
+    begin_immediate(db)
+    if not remove_qty_many(case_code, upc_map, LOCATION_CASE):
+        db.rollback()
+        flash(INVENTORY_CHANGED_MSG, "danger")
+        return redirect(url_for("view_case", case_code=case_code))
     for upc, qty in upc_map.items():
-        ok, _ = remove_qty(case_code, upc, qty, LOCATION_CASE)
-        if ok:
-            log_history(
-                ACTION_SOLD,
-                upc=upc,
-                qty=qty,
-                from_case_code=case_code,
-                notes="Sold from case workbench",
-                trans_reg=sold_fields["trans_reg"],
-                dept_no=sold_fields["dept_no"],
-                brief_desc=sold_fields["brief_desc"],
-                ticket_price=sold_fields["ticket_price"],
-                diamond_test=sold_fields["diamond_test"],
-            )
+        log_history(
+            ACTION_SOLD,
+            upc=upc,
+            qty=qty,
+            from_case_code=case_code,
+            notes="Sold from case workbench",
+            trans_reg=sold_fields["trans_reg"],
+            dept_no=sold_fields["dept_no"],
+            brief_desc=sold_fields["brief_desc"],
+            ticket_price=sold_fields["ticket_price"],
+            diamond_test=sold_fields["diamond_test"],
+        )
+    _flush_history(db)
     db.commit()
+    invalidate_case_cache(current_location_id())
 
     flash(f"Sold {sum(upc_map.values())} unit(s) from case {case_code}.", "success")
     return redirect(url_for("view_case", case_code=case_code))
@@ -2188,11 +2894,16 @@ def missing_from_case(case_code: str):
         return redirect(url_for("view_case", case_code=case_code))
 
     db = get_db()
+    begin_immediate(db)
+    if not remove_qty_many(case_code, upc_map, LOCATION_CASE):
+        db.rollback()
+        flash(INVENTORY_CHANGED_MSG, "danger")
+        return redirect(url_for("view_case", case_code=case_code))
     for upc, qty in upc_map.items():
-        ok, _ = remove_qty(case_code, upc, qty, LOCATION_CASE)
-        if ok:
-            log_history(ACTION_MISSING, upc=upc, qty=qty, from_case_code=case_code, notes=notes or "Marked missing from case workbench")
+        log_history(ACTION_MISSING, upc=upc, qty=qty, from_case_code=case_code, notes=notes or "Marked missing from case workbench")
+    _flush_history(db)
     db.commit()
+    invalidate_case_cache(current_location_id())
 
     flash(f"Marked MISSING: {sum(upc_map.values())} unit(s) from case {case_code}.", "success")
     return redirect(url_for("view_case", case_code=case_code))
@@ -2218,9 +2929,10 @@ def receive():
             return redirect(url_for("receive"))
 
         db = get_db()
+        begin_immediate(db)
+        upsert_products(upc_map, description, item_type=item_type)
+        add_qty_many(new_receipts_code, upc_map, LOCATION_CASE)
         for upc, qty in upc_map.items():
-            upsert_product(upc, description, item_type=item_type)
-            add_qty(new_receipts_code, upc, qty, LOCATION_CASE)
             log_history(
                 ACTION_RECEIVE,
                 upc=upc,
@@ -2228,7 +2940,9 @@ def receive():
                 to_case_code=new_receipts_code,
                 notes=f"Received into New Receipts ({item_type})",
             )
+        _flush_history(db)
         db.commit()
+        invalidate_case_cache(location_id)
 
         flash(f"Received {sum(upc_map.values())} unit(s) into New Receipts.", "success")
         return redirect(url_for("view_case", case_code=new_receipts_code))
@@ -2266,17 +2980,6 @@ def returns():
             flash("Price must be a valid number (example: 199.99).", "danger")
             return redirect(url_for("returns"))
 
-        if not ensure_case_exists(returns_code):
-            db = get_db()
-            db.execute(
-                """
-                INSERT OR IGNORE INTO cases (case_code, location_id, case_name, is_virtual, is_active, created_at)
-                VALUES (?, ?, ?, 1, 1, ?)
-                """,
-                (returns_code, location_id, RETURNS_NAME, utc_now()),
-            )
-            db.commit()
-
         upsert_product(upc, description, item_type=item_type)
         add_qty(returns_code, upc, 1, LOCATION_CASE)
         log_history(
@@ -2290,6 +2993,10 @@ def returns():
             ticket_price=price,
             diamond_test=diamond_test,
         )
+        db = get_db()
+        _flush_history(db)
+        db.commit()
+        invalidate_case_cache(location_id)
 
         flash(f"Return added to {returns_code}.", "success")
         return redirect(url_for("view_case", case_code=returns_code))
@@ -2303,15 +3010,7 @@ def returns():
 def move():
     db = get_db()
     location_id = current_location_id()
-    active_cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual
-        FROM cases c
-        WHERE c.is_active=1 AND c.location_id=?
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    active_cases = _active_cases(location_id)
 
     if request.method == "POST":
         from_case = (request.form.get("from_case_code") or "").strip()
@@ -2336,13 +3035,18 @@ def move():
             flash("Not enough quantity to move for: " + "; ".join(problems), "danger")
             return redirect(url_for("move"))
 
+        begin_immediate(db)
+        if not remove_qty_many(from_case, upc_map, LOCATION_CASE):
+            db.rollback()
+            flash(INVENTORY_CHANGED_MSG, "danger")
+            return redirect(url_for("move"))
+        upsert_products(upc_map, description)
+        add_qty_many(to_case, upc_map, LOCATION_CASE)
         for upc, qty in upc_map.items():
-            upsert_product(upc, description, item_type=None)
-            ok, _ = remove_qty(from_case, upc, qty, LOCATION_CASE)
-            if ok:
-                add_qty(to_case, upc, qty, LOCATION_CASE)
-                log_history(ACTION_MOVE, upc=upc, qty=qty, from_case_code=from_case, to_case_code=to_case, notes="Moved qty (bulk move page)")
+            log_history(ACTION_MOVE, upc=upc, qty=qty, from_case_code=from_case, to_case_code=to_case, notes="Moved qty (bulk move page)")
+        _flush_history(db)
         db.commit()
+        invalidate_case_cache(location_id)
 
         flash(f"Moved {sum(upc_map.values())} unit(s) from {from_case} → {to_case}.", "success")
         return redirect(url_for("view_case", case_code=to_case))
@@ -2361,15 +3065,7 @@ def move():
 def sell():
     db = get_db()
     location_id = current_location_id()
-    active_cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual
-        FROM cases c
-        WHERE c.is_active=1 AND c.location_id=?
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    active_cases = _active_cases(location_id)
 
     if request.method == "POST":
         upc = (request.form.get("upc") or "").strip()
@@ -2397,7 +3093,6 @@ def sell():
             flash(f"Not enough qty in case {case_code}. Requested {qty}, have {have}.", "danger")
             return redirect(url_for("sell"))
 
-        db.commit()
         log_history(
             ACTION_SOLD,
             upc=upc,
@@ -2410,6 +3105,9 @@ def sell():
             ticket_price=sold_fields["ticket_price"],
             diamond_test=sold_fields["diamond_test"],
         )
+        _flush_history(db)
+        db.commit()
+        invalidate_case_cache(location_id)
         flash(f"Sold {qty} unit(s) of {upc} from case {case_code}.", "success")
         return redirect(url_for("view_case", case_code=case_code))
 
@@ -2421,15 +3119,7 @@ def sell():
 def missing():
     db = get_db()
     location_id = current_location_id()
-    active_cases = db.execute(
-        f"""
-        SELECT c.case_code, c.case_name, c.is_virtual
-        FROM cases c
-        WHERE c.is_active=1 AND c.location_id=?
-        {case_order_sql()}
-        """,
-        (location_id,),
-    ).fetchall()
+    active_cases = _active_cases(location_id)
 
     if request.method == "POST":
         upc = (request.form.get("upc") or "").strip()
@@ -2453,8 +3143,10 @@ def missing():
             flash(f"Not enough qty in case {case_code}. Requested {qty}, have {have}.", "danger")
             return redirect(url_for("missing"))
 
-        db.commit()
         log_history(ACTION_MISSING, upc=upc, qty=qty, from_case_code=case_code, notes=notes or "Missing (standalone)")
+        _flush_history(db)
+        db.commit()
+        invalidate_case_cache(location_id)
         flash(f"Marked MISSING: {qty} unit(s) of {upc} from case {case_code}.", "success")
         return redirect(url_for("view_case", case_code=case_code))
 
@@ -2476,26 +3168,15 @@ def history():
     action = (request.args.get("action") or "").strip()
     date = (request.args.get("date") or "").strip()  # YYYY-MM-DD (store-local) for counts
 
-    active_cases = db.execute(
-        f"SELECT c.* FROM cases c WHERE c.is_active=1 AND c.location_id=? {case_order_sql()}",
-        (location_id,),
-    ).fetchall()
+    active_cases = _active_cases(location_id)
 
     if report_type == "counts":
-        sql = "SELECT * FROM case_counts WHERE location_id=?"
-        params = [location_id]
-        if case_code:
-            sql += " AND case_code=?"
-            params.append(case_code)
-        if date:
-            sql += " AND local_date=?"
-            params.append(date)
-        sql += " ORDER BY id DESC LIMIT 500"
+        sql, params = _history_query(location_id, report_type, case_code, upc, action, date, HISTORY_PAGE_SIZE)
         rows = db.execute(sql, params).fetchall()
-        # Current system totals (used to show variance in the report)
+        # Current system totals (used to show variance in the report), once per case
         sys_totals_counts = {
-            r["case_code"]: case_type_totals(r["case_code"], location_id=location_id)
-            for r in rows
+            code: case_type_totals(code, location_id=location_id)
+            for code in {r["case_code"] for r in rows}
         }
 
         return render_template(
@@ -2512,30 +3193,17 @@ def history():
             user=current_user(),
         )
 
-    sql = """
-        SELECT h.*, p.item_type
-        FROM history h
-        LEFT JOIN products p ON p.upc = h.upc
-        WHERE h.location_id=?
-    """
-    params = [location_id]
-    if case_code:
-        sql += " AND (h.from_case_code=? OR h.to_case_code=?)"
-        params.extend([case_code, case_code])
-    if upc:
-        sql += " AND h.upc=?"
-        params.append(upc)
-    if action:
-        sql += " AND h.action LIKE ?"
-        params.append(action)
-
-    sql += " ORDER BY id DESC LIMIT 500"
+    sql, params = _history_query(
+        location_id, report_type, case_code, upc, action, date, HISTORY_PAGE_SIZE, after_id=_after_id_arg()
+    )
     rows = db.execute(sql, params).fetchall()
+    next_after_id = rows[-1]["id"] if len(rows) == HISTORY_PAGE_SIZE else None
 
     return render_template(
         "history.html",
         report_type=report_type,
         rows=rows,
+        next_after_id=next_after_id,
         active_cases=active_cases,
         case_code=case_code,
         upc=upc,
@@ -2547,14 +3215,95 @@ def history():
 
 
 
+CSV_CHUNK_ROWS = 1000
+
+
+def _csv_stream(header: list, sql: str, params):
+    """
+    Yield CSV text a chunk of rows at a time (one reused buffer).
+    Rows come back as plain tuples in SELECT order, so the query must already
+    produce export-ready values (COALESCE in SQL) for csv.writer.writerows.
+    The query runs inside the generator: by the time a streamed body is read
+    the request's g.db has been torn down, so it borrows a pooled read
+    connection in the streaming context instead.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(header)
+    yield buf.getvalue()
+    cur = get_read_db().cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    while True:
+        rows = cur.fetchmany(CSV_CHUNK_ROWS)
+        if not rows:
+            break
+        buf.seek(0)
+        buf.truncate(0)
+        w.writerows(rows)
+        yield buf.getvalue()
+
+
+def _gzip_stream(chunks):
+    """gzip-encode a text stream chunk by chunk (level 1: CSV text compresses well even at the fastest level)."""
+    z = zlib.compressobj(1, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = z.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield z.flush()
+
+
+def csv_response(chunks, filename: str, etag: Optional[str] = None) -> Response:
+    gzipped = request.accept_encodings.quality("gzip") > 0
+    if gzipped:
+        chunks = _gzip_stream(chunks)
+    resp = Response(
+        stream_with_context(chunks),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
+    resp.vary.add("Accept-Encoding")
+    if gzipped:
+        resp.content_encoding = "gzip"
+    if etag:
+        _set_export_validator(resp, etag)
+    return resp
+
+
+def inventory_etag(location_id: int) -> str:
+    """Weak validator for the inventory exports (data_version is global: products are shared)."""
+    return f"{location_id}-{data_version()}"
+
+
+def _set_export_validator(resp: Response, etag: str) -> None:
+    resp.set_etag(etag, weak=True)
+    # Login-gated: browsers may keep a copy but must revalidate every time
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """304 response if the client's If-None-Match already has this export."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    resp = Response(status=304)
+    # Same headers as the 200 it stands in for (csv_response may gzip)
+    resp.vary.add("Accept-Encoding")
+    _set_export_validator(resp, etag)
+    return resp
+
+
 @app.route("/export/inventory.csv")
 @login_required
 def export_inventory():
     """Export current inventory (by case/upc/qty)."""
-    db = get_db()
     location_id = current_location_id()
-    rows = db.execute(
-        """
+    etag = inventory_etag(location_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    sql = """
         SELECT
           i.case_code,
           c.case_name,
@@ -2568,23 +3317,13 @@ def export_inventory():
         LEFT JOIN products p ON p.upc = i.upc
         WHERE c.is_active = 1 AND i.qty > 0 AND c.location_id = ?
         ORDER BY i.case_code, i.location, i.upc
-        """,
-        (location_id,),
-    ).fetchall()
-
-    import io, csv
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["case_code","case_name","location","upc","item_type","description","qty"])
-    for r in rows:
-        w.writerow([r["case_code"], r["case_name"], r["location"], r["upc"], r["item_type"], r["description"], int(r["qty"])])
+        """
 
-    data = buf.getvalue().encode("utf-8")
-    filename = f"inventory_{now_local_dt().strftime('%m-%d-%Y_%H%M')}.csv"
-    resp = make_response(data)
-    resp.headers["Content-Type"] = "text/csv; charset=utf-8"
-    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    return resp
+    filename = f"inventory_{export_stamp()}.csv"
+    return csv_response(_csv_stream(
+        ["case_code","case_name","location","upc","item_type","description","qty"],
+        sql, (location_id,),
+    ), filename, etag)
 
 
 @app.route("/export/case/<case_code>.csv")
@@ -2599,11 +3338,16 @@ def export_case(case_code):
     ).fetchone()
     if not c:
         abort(404)
+    etag = inventory_etag(location_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
-    rows = db.execute(
-        """
-        SELECT i.upc,
+    sql = """
+        SELECT ? AS case_code,
+               ? AS case_name,
                i.location,
+               i.upc,
                COALESCE(p.item_type,'') AS item_type,
                COALESCE(p.description,'') AS description,
                i.qty
@@ -2611,27 +3355,16 @@ def export_case(case_code):
         LEFT JOIN products p ON p.upc = i.upc
         WHERE i.case_code = ? AND i.location_id = ? AND i.qty > 0
         ORDER BY i.location, i.upc
-        """,
-        (case_code, location_id),
-    ).fetchall()
-
-    import io, csv
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["case_code","case_name","location","upc","item_type","description","qty"])
-    for r in rows:
-        w.writerow([c["case_code"], c["case_name"], r["location"], r["upc"], r["item_type"], r["description"], int(r["qty"])])
+        """
 
-    data = buf.getvalue().encode("utf-8")
-    filename = f"case_{case_code}_{now_local_dt().strftime('%m-%d-%Y_%H%M')}.csv"
-    resp = make_response(data)
-    resp.headers["Content-Type"] = "text/csv; charset=utf-8"
-    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    return resp
+    filename = f"case_{case_code}_{export_stamp()}.csv"
+    return csv_response(_csv_stream(
+        ["case_code","case_name","location","upc","item_type","description","qty"],
+        sql, (c["case_code"], c["case_name"], case_code, location_id),
+    ), filename, etag)
 @app.route("/export/history.csv")
 @login_required
 def export_history():
-    db = get_db()
     location_id = current_location_id()
     report_type = (request.args.get("report") or "events").strip().lower()
     if report_type not in ("events", "counts"):
@@ -2642,86 +3375,37 @@ def export_history():
     action = (request.args.get("action") or "").strip()
     date = (request.args.get("date") or "").strip()
 
-    import io, csv
+    sql, params = _history_query(
+        location_id, report_type, case_code, upc, action, date, HISTORY_EXPORT_LIMIT, export=True
+    )
 
     if report_type == "counts":
-        sql = "SELECT * FROM case_counts WHERE location_id=?"
-        params = [location_id]
-        if case_code:
-            sql += " AND case_code=?"
-            params.append(case_code)
-        if date:
-            sql += " AND local_date=?"
-            params.append(date)
-        sql += " ORDER BY id DESC LIMIT 5000"
-        rows = db.execute(sql, params).fetchall()
-
-        output = io.StringIO()
-        w = csv.writer(output)
-        w.writerow([
-            "ts_utc",
-            "local_date",
-            "case_code",
-            "username",
-            "bracelets",
-            "rings",
-            "earrings",
-            "necklaces",
-            "other",
-            "reserve_bracelets",
-            "reserve_rings",
-            "reserve_earrings",
-            "reserve_necklaces",
-            "reserve_other",
-            "total",
-            "notes",
-        ])
-        for r in rows:
-            w.writerow([
-                r["ts_utc"], r["local_date"], r["case_code"], r["username"] or "",
-                r["bracelets"], r["rings"], r["earrings"], r["necklaces"], r["other"],
-                r["reserve_bracelets"], r["reserve_rings"], r["reserve_earrings"],
-                r["reserve_necklaces"], r["reserve_other"],
-                r["total"],
-                r["notes"] or ""
-            ])
-        return Response(
-            output.getvalue(),
-            mimetype="text/csv",
-            headers={"Content-Disposition": "attachment; filename=counts_history.csv"},
-        )
-
-    sql = "SELECT h.*, p.item_type FROM history h LEFT JOIN products p ON p.upc = h.upc WHERE h.location_id=?"
-    params = [location_id]
-    if case_code:
-        sql += " AND (h.from_case_code=? OR h.to_case_code=?)"
-        params.extend([case_code, case_code])
-    if upc:
-        sql += " AND h.upc=?"
-        params.append(upc)
-    if action:
-        sql += " AND h.action LIKE ?"
-        params.append(action)
-    sql += " ORDER BY h.id DESC LIMIT 5000"
-    rows = db.execute(sql, params).fetchall()
-
-    output = io.StringIO()
-    w = csv.writer(output)
-    w.writerow(["ts","username","action","upc","item_type","qty","from_case_code","to_case_code","notes","trans_reg","dept_no","brief_desc","ticket_price","diamond_test"])
-    for r in rows:
-        w.writerow([
-            r["ts"], r["username"] or "", r["action"], r["upc"] or "",
-            r["item_type"] or "", r["qty"] or "",
-            r["from_case_code"] or "", r["to_case_code"] or "", r["notes"] or "",
-            r["trans_reg"] or "", r["dept_no"] or "", r["brief_desc"] or "",
-            r["ticket_price"] if (r["ticket_price"] is not None) else "",
-            r["diamond_test"] or ""
-        ])
-    return Response(
-        output.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=events_history.csv"},
-    )
+        return csv_response(_csv_stream(
+            [
+                "ts_utc",
+                "local_date",
+                "case_code",
+                "username",
+                "bracelets",
+                "rings",
+                "earrings",
+                "necklaces",
+                "other",
+                "reserve_bracelets",
+                "reserve_rings",
+                "reserve_earrings",
+                "reserve_necklaces",
+                "reserve_other",
+                "total",
+                "notes",
+            ],
+            sql, params,
+        ), "counts_history.csv")
+
+    return csv_response(_csv_stream(
+        ["ts","username","action","upc","item_type","qty","from_case_code","to_case_code","notes","trans_reg","dept_no","brief_desc","ticket_price","diamond_test"],
+        sql, params,
+    ), "events_history.csv")
 
 
 @app.route("/admin/users", methods=["GET", "POST"])
@@ -2779,8 +3463,9 @@ def users():
             """,
             (username, generate_password_hash(password), role, 1, location_id, utc_now()),
         )
-        db.commit()
         log_history(ACTION_USER_CREATE, notes=f"Created user {username} ({role})")
+        _flush_history(db)
+        db.commit()
         flash("User created.", "success")
         return redirect(url_for("users"))
 
@@ -2811,8 +3496,9 @@ def disable_user(user_id: int):
         return redirect(url_for("users"))
 
     db.execute("UPDATE users SET is_active=0 WHERE id=?", (user_id,))
-    db.commit()
     log_history(ACTION_USER_DISABLE, notes=f"Disabled user_id={user_id}")
+    _flush_history(db)
+    db.commit()
     flash("User disabled.", "success")
     return redirect(url_for("users"))
 
@@ -2821,28 +3507,34 @@ def disable_user(user_id: int):
 @login_required
 def daily_activity_reports():
     # Choose date and case, then download report
-    db = get_db()
     location_id = current_location_id()
-    cases = db.execute(
-        "SELECT case_code, case_name FROM cases WHERE is_active = 1 AND location_id = ? ORDER BY case_code",
-        (location_id,),
-    ).fetchall()
-    # default date in store local
-    default_date = local_date_str()
-    date_q = request.args.get("date") or default_date
-    # Accept MM/DD/YYYY too
-    if re.match(r"^\d{2}/\d{2}/\d{4}$", date_q):
-        mm, dd, yyyy = date_q.split("/")
-        date_q = f"{yyyy}-{mm}-{dd}"
+    # Reuses the cached case-picker list (invalidated on case create/edit/delete);
+    # this page lists cases by code rather than grid order.
+    cases = sorted(_active_cases(location_id), key=lambda c: c["case_code"])
+    date_q = report_date_arg()
     return render_template("daily_reports.html", cases=cases, date=date_q, user=current_user())
 
+
+XLSX_SPOOL_MAX = 1024 * 1024
+
+
+def xlsx_response(wb, filename: str) -> Response:
+    """Save a workbook to a spooled temp file (memory up to 1 MB, then disk) and send it in blocks."""
+    tmp = tempfile.SpooledTemporaryFile(max_size=XLSX_SPOOL_MAX)
+    wb.save(tmp)
+    tmp.seek(0)
+    return send_file(
+        tmp,
+        as_attachment=True,
+        download_name=filename,
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
 @app.route("/reports/daily/<case_code>.xlsx")
 @login_required
 def download_daily_activity_report(case_code):
-    date_q = request.args.get("date") or local_date_str()
-    if re.match(r"^\d{2}/\d{2}/\d{4}$", date_q):
-        mm, dd, yyyy = date_q.split("/")
-        date_q = f"{yyyy}-{mm}-{dd}"
+    date_q = report_date_arg()
 
     # Ensure case exists
     db = get_db()
@@ -2856,28 +3548,14 @@ def download_daily_activity_report(case_code):
 
     wb = build_daily_activity_workbook(case_code, date_q, location_id)
 
-    import io
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-
     safe_date = date_q.replace("-", "")
-    filename = f"Daily_Activity_{case_code}_{safe_date}.xlsx"
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+    return xlsx_response(wb, f"Daily_Activity_{case_code}_{safe_date}.xlsx")
 
 
 @app.route("/reports/daily-counts/<case_code>.xlsx")
 @login_required
 def download_daily_count_report(case_code):
-    date_q = request.args.get("date") or local_date_str()
-    if re.match(r"^\d{2}/\d{2}/\d{4}$", date_q):
-        mm, dd, yyyy = date_q.split("/")
-        date_q = f"{yyyy}-{mm}-{dd}"
+    date_q = report_date_arg()
 
     db = get_db()
     location_id = current_location_id()
@@ -2890,19 +3568,8 @@ def download_daily_count_report(case_code):
 
     wb = build_daily_count_workbook(case_code, date_q, location_id)
 
-    import io
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-
     safe_date = date_q.replace("-", "")
-    filename = f"Daily_Count_{case_code}_{safe_date}.xlsx"
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-    )
+    return xlsx_response(wb, f"Daily_Count_{case_code}_{safe_date}.xlsx")
 
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,52 @@
+import sys, sqlite3, tempfile
+from pathlib import Path
+import importlib.util
+
+ROOT = Path(__file__).resolve().parent
+
+# Import app as real module name so dataclasses don't break
+spec = importlib.util.spec_from_file_location('app', str(ROOT/'app.py'))
+appmod = importlib.util.module_from_spec(spec)
+sys.modules['app'] = appmod
+spec.loader.exec_module(appmod)
+
+tmpdir = tempfile.TemporaryDirectory()
+DB = Path(tmpdir.name) / 'inventory.db'
+appmod.DB_PATH = DB
+app = appmod.app
+
+
+def assert_(cond, msg):
+    if not cond:
+        raise AssertionError(msg)
+
+# 1) Build a DB with the current schema, then take it back to the pre-item_type history table
+#    with no virtual cases
+appmod.init_db()
+con = sqlite3.connect(DB)
+con.execute("INSERT INTO products (upc, description, item_type) VALUES ('111', 'Gold Ring', 'Ring')")
+con.execute("INSERT INTO history (ts, action, upc, qty, location_id) VALUES ('2024-01-01T00:00:00+00:00', 'RECEIVE', '111', 1, 1)")
+con.execute("ALTER TABLE history DROP COLUMN item_type")
+con.execute("DELETE FROM cases WHERE is_virtual = 1")
+con.commit()
+con.close()
+
+# 2) Startup as `python app.py` does, then a request that never commits
+appmod._close_read_pool()
+appmod._virtual_cases_ready = False
+appmod.init_db()
+client = app.test_client()
+r = client.get('/setup')
+assert_(r.status_code == 200, f"setup page should 200, got {r.status_code}")
+
+# 3) The item_type backfill and the virtual cases must have been committed by get_db itself
+con = sqlite3.connect(DB)
+cols = [row[1] for row in con.execute("PRAGMA table_info(history)")]
+assert_('item_type' in cols, f"history.item_type missing after migration: {cols}")
+rows = con.execute("SELECT upc, item_type FROM history").fetchall()
+assert_(rows == [('111', 'Ring')], f"expected backfilled item_type, got {rows}")
+virtual = sorted(row[0] for row in con.execute("SELECT case_code FROM cases WHERE is_virtual = 1"))
+assert_(virtual == ['NEW-RECEIPTS', 'RETURNS'], f"virtual cases not committed: {virtual}")
+con.close()
+
+print('MIGRATION_TEST_OK')